@@ -0,0 +1,668 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#性能测试
+#
+#调用方法：
+#python benchmark.py parse [--pages 保存的页面目录] [--repeat 次数]
+#    每条微博的解析耗时。没有指定页面目录时，用仓库中自带的*/*.csv生成与weibo.cn
+#    结构一致的主页页面
+#python benchmark.py segment [--workers 进程数] [--repeat 次数]
+#    对自带的*/*.csv中的全部微博分词，对比单进程和多进程的耗时和结果
+#python benchmark.py layout [--sizes 形状图片放大倍数,...] [--max-words 词数] [--grid 网格倍数]
+#    对比在原始分辨率和缩小的网格上排布词云的耗时
+#python benchmark.py startup [--repeat 次数]
+#    用python -X importtime统计只抓取、只生成图片时的启动耗时，与启动时导入全部库对比
+#python benchmark.py suite [--fixtures 录制的页面目录] [--latency 秒] [--error-rate 比例]
+#                          [--output 结果文件]
+#    启动本地的weibo.cn模拟服务器，测试抓取(get_weibo_info)、翻页解析(get_one_page)、
+#    get_texts、cloud_pic和pic_mix的耗时、吞吐量和内存峰值，结果写入json文件，
+#    便于对比不同版本
+#python benchmark.py stub [--port 端口] [--fixtures 录制的页面目录] [--latency 秒] [--error-rate 比例]
+#    只启动模拟服务器，配置base_url为http://127.0.0.1:端口即可让爬虫访问它
+#python benchmark.py record --user-id 用户id --cookie cookie [--pages 页数] [--output 目录]
+#    从weibo.cn录制用户资料页、主页和长微博全文页，供模拟服务器使用
+
+import argparse
+import contextlib
+import csv
+import glob
+import html
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+from lxml import etree
+
+import weibo_cloud
+
+BASE_DIR = os.path.split(os.path.realpath(__file__))[0]
+PER_PAGE = 10  # weibo.cn每页显示10条微博
+LONG_PREFIX = 60  # 模拟长微博时主页上显示的字数
+
+
+def read_rows(path):
+    """读取csv中的微博数据行(跳过表头)"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        return [row for row in csv.reader(f) if row and row[0] != '微博id']
+
+
+def render_post(row, pinned=False, long=False):
+    """将一行微博数据渲染为weibo.cn中的一条微博，long为True时只显示开头并带"全文"链接"""
+    weibo_id, content, place, publish_time, tool, up, retweet, comment = row[:8]
+    publish_time = datetime.strptime(publish_time, '%Y-%m-%d %H:%M')
+    if publish_time.year == datetime.now().year:
+        str_time = publish_time.strftime('%m月%d日 %H:%M')
+    else:
+        str_time = publish_time.strftime('%Y-%m-%d %H:%M:%S')
+    kt = '<span class="kt">置顶</span>' if pinned else ''
+    full = ''
+    if long:
+        content = content[:LONG_PREFIX]
+        full = '<a href="/comment/%s">全文</a>' % weibo_id
+    return ('<div class="c" id="M_%s"><div>%s<span class="ctt">%s</span>%s</div>'
+            '<div><a href="/attitude/%s">赞[%s]</a>&nbsp;'
+            '<a href="/repost/%s">转发[%s]</a>&nbsp;'
+            '<a href="/comment/%s" class="cc">评论[%s]</a>&nbsp;'
+            '<span class="ct">%s&nbsp;来自%s</span></div></div>'
+            '<div class="s"></div>') % (weibo_id, kt, html.escape(content),
+                                        full, weibo_id, up, weibo_id, retweet,
+                                        weibo_id, comment, str_time,
+                                        html.escape(tool))
+
+
+def is_long(row):
+    """模拟为长微博的微博：正文较长且带有"全文"字样"""
+    return u'全文' in row[1] and len(row[1]) > LONG_PREFIX
+
+
+def render_profile_page(user_id, nickname, rows, page, long=False):
+    """渲染用户主页的第page页，rows需按发布时间倒序排列。long为True时模拟长微博"""
+    page_num = max((len(rows) + PER_PAGE - 1) // PER_PAGE, 1)
+    posts = ''.join(
+        render_post(row, long=long and is_long(row))
+        for row in rows[(page - 1) * PER_PAGE:page * PER_PAGE])
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><html><head>'
+        '<meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>'
+        '<title>%s的微博</title></head><body>'
+        '<div class="u"><a href="/%s/info">资料</a></div>'
+        '<div class="tip2"><span class="tc">微博[%d]</span>&nbsp;'
+        '<a href="/%s/follow">关注[100]</a>&nbsp;'
+        '<a href="/%s/fans">粉丝[1000]</a></div>%s'
+        '<div class="pa" id="pagelist"><form><div>'
+        '<input name="mp" type="hidden" value="%d" /></div></form></div>'
+        '<div class="c">设置:皮肤.图片</div><div class="c">weibo.cn</div>'
+        '</body></html>') % (html.escape(nickname), user_id, len(rows), user_id,
+                             user_id, posts, page_num)
+
+
+def render_info_page(nickname):
+    """渲染用户资料页"""
+    return ('<html><head><meta http-equiv="Content-Type" '
+            'content="text/html; charset=utf-8"/><title>%s的资料</title>'
+            '</head><body></body></html>') % html.escape(nickname)
+
+
+def render_comment_page(row):
+    """渲染长微博的全文页"""
+    return ('<html><head><meta http-equiv="Content-Type" '
+            'content="text/html; charset=utf-8"/><title>评论列表</title></head>'
+            '<body><div class="c">weibo.cn</div><div class="c">'
+            '<span class="ctt">:%s</span><span class="ct">%s</span></div>'
+            '</body></html>') % (html.escape(row[1]), row[3])
+
+
+def load_corpora():
+    """读取仓库中自带的全部微博数据，返回{(user_id, nickname): rows}"""
+    corpora = OrderedDict()
+    for path in sorted(glob.glob(os.path.join(BASE_DIR, '*', '*.csv'))):
+        nickname = os.path.basename(os.path.dirname(path))
+        user_id = os.path.splitext(os.path.basename(path))[0]
+        rows = [row for row in read_rows(path) if len(row) >= 8]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        corpora[(user_id, nickname)] = rows
+    return corpora
+
+
+def load_profile_pages(pages_dir=None):
+    """读取保存的主页页面(*.html)，未指定目录时由自带数据生成"""
+    if pages_dir:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(pages_dir, '*.html'))):
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+        return pages
+    pages = []
+    for (user_id, nickname), rows in load_corpora().items():
+        page_num = (len(rows) + PER_PAGE - 1) // PER_PAGE
+        for page in range(1, page_num + 1):
+            pages.append(
+                render_profile_page(user_id, nickname, rows,
+                                    page).encode('utf-8'))
+    return pages
+
+
+def get_weibo():
+    """创建一个不访问网络的Weibo对象"""
+    return weibo_cloud.Weibo({
+        'user_id_list': ['0'],
+        'filter': 0,
+        'since_date': 1,
+        'write_mode': ['csv'],
+        'pic_download': 0,
+        'video_download': 0,
+        'cookie': '',
+        'rate_limit': 0,
+    })
+
+
+def legacy_weibo_content(wb, info, is_original):
+    """旧实现的微博正文：原创微博取“赞”之前的文本，转发微博拼接转发理由和原始用户。
+    带“全文”链接的长微博保留截断的内容(旧实现会同步获取全文，对照时不访问网络)"""
+    weibo_content = wb.handle_garbled(info)
+    if is_original:
+        return weibo_content[:weibo_content.rfind(u'赞')]
+    weibo_content = weibo_content[weibo_content.find(':') +
+                                  1:weibo_content.rfind(u'赞')]
+    weibo_content = weibo_content[:weibo_content.rfind(u'赞')]
+    retweet_reason = wb.handle_garbled(info.xpath('div')[-1])
+    retweet_reason = retweet_reason[:retweet_reason.rindex(u'赞')]
+    original_user = info.xpath("div/span[@class='cmt']/a/text()")
+    if original_user:
+        return (retweet_reason + '\n' + u'原始用户: ' + original_user[0] + '\n' +
+                u'转发内容: ' + weibo_content)
+    return retweet_reason + '\n' + u'转发内容: ' + weibo_content
+
+
+def legacy_one_weibo(wb, info):
+    """逐字段xpath提取的旧实现，作为对照"""
+    weibo = OrderedDict()
+    is_original = len(info.xpath("div/span[@class='cmt']")) <= 3
+    if (not wb.filter) or is_original:
+        str_time = wb.handle_garbled(info.xpath("div/span[@class='ct']")[0])
+        footer = wb.parse_weibo_footer(wb.handle_garbled(info.xpath('div')[-1]))
+        weibo['id'] = info.xpath('@id')[0][2:]
+        weibo['content'] = legacy_weibo_content(wb, info, is_original)
+        weibo['publish_place'] = wb.parse_publish_place(info.xpath('div')[0])
+        weibo['publish_time'] = wb.parse_publish_time(str_time)
+        weibo['publish_tool'] = wb.parse_publish_tool(
+            wb.handle_garbled(info.xpath("div/span[@class='ct']")[0]))
+        weibo['up_num'] = footer['up_num']
+        weibo['retweet_num'] = footer['retweet_num']
+        weibo['comment_num'] = footer['comment_num']
+    return weibo
+
+
+def bench_parse(args):
+    """对比每条微博的解析耗时"""
+    wb = get_weibo()
+    posts = []
+    for page in load_profile_pages(args.pages):
+        info = etree.HTML(page).xpath("//div[@class='c']")
+        posts.extend(info[:len(info) - 2])
+    print(u'共%d条微博，重复%d次' % (len(posts), args.repeat))
+    results = OrderedDict()
+    for name, parse in [('legacy', lambda info: legacy_one_weibo(wb, info)),
+                        ('single_pass', wb.get_one_weibo)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            parsed = [parse(info) for info in posts]
+        elapsed = time.perf_counter() - start
+        results[name] = parsed
+        print(u'%-12s 每条微博 %.1f 微秒' %
+              (name, elapsed / (len(posts) * args.repeat) * 1e6))
+    legacy = [list(weibo.values()) for weibo in results['legacy']]
+    single_pass = [
+        weibo.values() if weibo else [] for weibo in results['single_pass']
+    ]
+    if legacy != single_pass:
+        sys.exit(u'两种实现的解析结果不一致')
+
+
+def bench_segment(args):
+    """对比单进程和多进程分词的耗时，并检查结果一致"""
+    texts = [
+        row[1].strip() for rows in load_corpora().values() for row in rows
+    ] * args.repeat
+    print(u'共%d条微博' % len(texts))
+    weibo_cloud.jieba.initialize()
+    weibo_cloud.get_segment_pool(args.workers).submit(len, '').result()  # 预先启动进程
+    results = OrderedDict()
+    for workers in [1, args.workers]:
+        start = time.perf_counter()
+        word_counter = weibo_cloud.WordCounter(workers)
+        for text in texts:
+            word_counter.add(text)
+        results[workers] = list(word_counter.result().items())
+        print(u'%d个进程 %.2f 秒' % (workers, time.perf_counter() - start))
+    if results[1] != results[args.workers]:
+        sys.exit(u'单进程和多进程的分词结果不一致')
+
+
+def bench_layout(args):
+    """对比full和grid两种排布方式在不同形状图片大小下的耗时"""
+    words = weibo_cloud.Counter()
+    for rows in load_corpora().values():
+        for row in rows:
+            words.update(weibo_cloud.get_token_filter().cut(row[1]))
+    mask = weibo_cloud.Image.open(os.path.join(BASE_DIR, 'run.png'))
+    tmp_dir = tempfile.mkdtemp()
+    for size in [float(size) for size in args.sizes.split(',')]:
+        path = os.path.join(tmp_dir, 'run_%s.png' % size)
+        mask.resize((int(mask.width * size), int(mask.height * size)),
+                    weibo_cloud.Image.NEAREST).save(path)
+        line = []
+        for layout in ['full', 'grid']:
+            start = time.perf_counter()
+            image = weibo_cloud.cloud_pic(words, args.max_words, path, layout,
+                                          args.grid)
+            line.append(u'%s %.2f秒 %dx%d' % (layout, time.perf_counter() - start,
+                                              image.width, image.height))
+        print(u'形状图片%dx%d: %s' % (int(mask.width * size),
+                                 int(mask.height * size), ', '.join(line)))
+    shutil.rmtree(tmp_dir)
+
+
+class StubSite(object):
+    """模拟的weibo.cn页面：由自带的*/*.csv生成用户资料页、主页和长微博全文页，
+    或读取record录制的页面。可模拟网络延迟和按比例返回错误"""
+    def __init__(self, fixtures=None, latency=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.pages = {}  # 路径 -> 页面
+        self.users = OrderedDict()  # 用户id -> 微博数
+        if fixtures:
+            for path in glob.glob(os.path.join(fixtures, '*.html')):
+                with open(path, 'rb') as f:
+                    self.pages[fixture_path(path)] = f.read()
+            for path in self.pages:
+                match = re.match(r'^/(\w+)/info$', path)
+                if match:
+                    self.users[match.group(1)] = 0
+            return
+        for (user_id, nickname), rows in load_corpora().items():
+            self.users[user_id] = len(rows)
+            self.pages['/%s/info' % user_id] = render_info_page(nickname)
+            page_num = max((len(rows) + PER_PAGE - 1) // PER_PAGE, 1)
+            for page in range(1, page_num + 1):
+                self.pages['/%s/profile?page=%d' % (user_id, page)] = (
+                    render_profile_page(user_id, nickname, rows, page, True))
+            self.pages['/%s/profile' % user_id] = self.pages[
+                '/%s/profile?page=1' % user_id]
+            for row in rows:
+                if is_long(row):
+                    self.pages['/comment/' + row[0]] = render_comment_page(row)
+        self.pages = {
+            path: page.encode('utf-8')
+            for path, page in self.pages.items()
+        }
+
+    def get(self, path):
+        """返回(状态码, 页面)"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 503, b'Service Unavailable'
+        page = self.pages.get(path)
+        if page is None:
+            return 404, b'Not Found'
+        return 200, page
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟服务器的请求处理"""
+    def do_GET(self):
+        status, page = self.server.site.get(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(site, port=0):
+    """在后台线程中启动模拟服务器，返回(服务器, base_url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.site = site
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def fixture_name(path):
+    """录制页面的文件名"""
+    return quote(path, safe='') + '.html'
+
+
+def fixture_path(name):
+    """由录制页面的文件名还原路径"""
+    return unquote(os.path.basename(name)[:-len('.html')])
+
+
+def crawler_config(base_url, user_ids, write_mode=None):
+    """访问模拟服务器的爬虫配置：不限速、不缓存、不增量"""
+    return {
+        'user_id_list': list(user_ids),
+        'filter': 1,
+        'since_date': '2000-01-01',
+        'write_mode': write_mode or ['csv'],
+        'pic_download': 0,
+        'video_download': 0,
+        'cookie': 'benchmark',
+        'base_url': base_url,
+        'rate_limit': 0,
+        'incremental': 0,
+    }
+
+
+def max_rss():
+    """本进程的内存峰值(KB)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def suite_crawl(base_url, user_ids):
+    """get_weibo_info：完整抓取全部用户并写入csv"""
+    wb = weibo_cloud.Weibo(crawler_config(base_url, user_ids))
+    count = 0
+    for user_config in wb.user_config_list:
+        wb.initialize_info(user_config)
+        wb.get_weibo_info()
+        count += wb.got_num
+    wb.fetcher.close()
+    return count
+
+
+def suite_get_one_page(base_url, user_ids):
+    """get_one_page：逐页获取并解析(不预取)，最后等待长微博全文"""
+    wb = weibo_cloud.Weibo(crawler_config(base_url, user_ids))
+    count = 0
+    for user_config in wb.user_config_list:
+        wb.initialize_info(user_config)
+        selector = wb.handle_html(wb.get_page_url(1))
+        page_num = wb.get_page_num(selector) or 1
+        for page in range(1, page_num + 1):
+            wb.get_one_page(page)
+        wb.expand_long_weibos()
+        count += wb.got_num
+    wb.fetcher.close()
+    return count
+
+
+def suite_get_texts(base_url, user_ids):
+    """get_texts：对自带的全部csv分词(不使用分词缓存)并查询点赞最多的微博。
+    数据复制到工作目录并预先生成互动数索引，只计时get_texts本身"""
+    paths = []
+    for path in sorted(glob.glob(os.path.join(BASE_DIR, '*', '*.csv'))):
+        copy_path = os.path.join('get_texts', os.path.relpath(path, BASE_DIR))
+        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+        shutil.copyfile(path, copy_path)
+        weibo_cloud.load_engagement_index(copy_path)
+        paths.append(copy_path)
+    count = sum(1 for path in paths for _ in weibo_cloud.read_posts(path))
+    start = time.perf_counter()
+    for path in paths:
+        weibo_cloud.get_texts(path, 24, 5, workers=1, token_cache=False)
+    return count, time.perf_counter() - start
+
+
+def get_suite_words():
+    """全部自带微博的词频"""
+    word_counter = weibo_cloud.WordCounter(1)
+    for rows in load_corpora().values():
+        for row in rows:
+            word_counter.add(row[1])
+    return word_counter.result()
+
+
+def suite_cloud_pic(base_url, user_ids):
+    """cloud_pic：由全部自带微博的词频生成词云(包括加载字体和形状图片)"""
+    words = get_suite_words()
+    start = time.perf_counter()
+    weibo_cloud.cloud_pic(words, backgroud_pic_path=os.path.join(
+        BASE_DIR, 'run.png'))
+    return 1, time.perf_counter() - start
+
+
+def suite_pic_mix(base_url, user_ids, repeat=20):
+    """pic_mix：将词云贴到底图上"""
+    region = weibo_cloud.Image.new('RGB', (1080, 700), (0, 0, 0))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        weibo_cloud.pic_mix(weibo_cloud.pic_blank(), region)
+    return repeat, time.perf_counter() - start
+
+
+SUITE = OrderedDict([
+    ('get_weibo_info', suite_crawl),
+    ('get_one_page', suite_get_one_page),
+    ('get_texts', suite_get_texts),
+    ('cloud_pic', suite_cloud_pic),
+    ('pic_mix', suite_pic_mix),
+])
+
+
+def run_suite_case(name, base_url, user_ids, work_dir):
+    """在子进程中运行一项测试，返回(数量, 耗时, 内存峰值, 运行指标)。
+    函数返回(数量, 耗时)时只统计其中计时的部分"""
+    os.chdir(work_dir)
+    weibo_cloud.metrics.reset()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = SUITE[name](base_url, user_ids)
+        elapsed = time.perf_counter() - start
+    if isinstance(result, tuple):
+        result, elapsed = result
+    return result, elapsed, max_rss(), weibo_cloud.metrics.summary()
+
+
+def get_version():
+    """当前代码的git版本"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def bench_suite(args):
+    """启动模拟服务器，逐项运行测试并写入json结果"""
+    site = StubSite(args.fixtures, args.latency, args.error_rate)
+    server, base_url = start_stub(site)
+    user_ids = list(site.users)
+    names = args.only.split(',') if args.only else list(SUITE)
+    work_dir = tempfile.mkdtemp()
+    results = OrderedDict()
+    try:
+        for name in names:
+            requests = site.requests
+            # 每项测试在新的子进程中运行，内存峰值互不影响
+            with multiprocessing.Pool(1) as pool:
+                count, elapsed, rss, summary = pool.apply(
+                    run_suite_case, (name, base_url, user_ids, work_dir))
+            results[name] = OrderedDict([
+                ('items', count),
+                ('seconds', round(elapsed, 4)),
+                ('throughput', round(count / elapsed, 2) if elapsed else None),
+                ('requests', site.requests - requests),
+                ('max_rss_kb', rss),
+                ('stages', summary['stages']),
+                ('counters', summary['counters']),
+            ])
+            print(u'%-15s %6d条 %8.3f秒 %10.1f条/秒 %5d次请求 内存峰值%dMB' %
+                  (name, count, elapsed, results[name]['throughput'] or 0,
+                   results[name]['requests'], rss // 1024))
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir)
+    report = OrderedDict([
+        ('version', get_version()),
+        ('time', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('stub', OrderedDict([('fixtures', args.fixtures or ''),
+                              ('latency', args.latency),
+                              ('error_rate', args.error_rate),
+                              ('errors', site.errors)])),
+        ('results', results),
+    ])
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(u'结果已写入%s' % args.output)
+
+
+def bench_stub(args):
+    """只运行模拟服务器"""
+    site = StubSite(args.fixtures, args.latency, args.error_rate)
+    server, base_url = start_stub(site, args.port)
+    print(u'模拟服务器%s，用户: %s' % (base_url, ', '.join(site.users)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def bench_record(args):
+    """录制用户资料页、主页的前几页和这些页中长微博的全文页"""
+    fetcher = weibo_cloud.Fetcher(cookies=[args.cookie], rate=0.5)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    def record(*paths):
+        page = fetcher.get(args.base_url + paths[0])
+        for path in paths:
+            with open(os.path.join(args.output, fixture_name(path)), 'wb') as f:
+                f.write(page)
+        print(paths[0])
+        return page
+
+    record('/%s/info' % args.user_id)
+    for page in range(1, args.pages + 1):
+        paths = ['/%s/profile?page=%d' % (args.user_id, page)]
+        if page == 1:
+            paths.append('/%s/profile' % args.user_id)
+        selector = etree.HTML(record(*paths))
+        for info in selector.xpath("//div[@class='c']"):
+            if u'全文' in info.xpath('div//a/text()'):
+                record('/comment/' + info.xpath('@id')[0][2:])
+    fetcher.close()
+
+
+STARTUP_SCENARIOS = OrderedDict([
+    ('import', 'import weibo_cloud'),
+    ('crawl', 'import weibo_cloud as w; w.requests.Session; w.etree.HTML'),
+    ('render', 'import weibo_cloud as w; w.get_token_filter(); '
+     'w.wordcloud.WordCloud; w.imageio.imread; w.ImageFont.truetype'),
+    ('eager', 'import weibo_cloud, requests, lxml.etree, wordcloud, '
+     'imageio.v2, jieba, PIL.Image, PIL.ImageDraw, PIL.ImageFont'),  # 原来的导入方式
+])
+
+
+def run_importtime(code):
+    """在新的解释器中运行code，返回(总耗时, {顶层模块: 导入耗时})，单位为秒"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=BASE_DIR,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True)
+    elapsed = time.perf_counter() - start
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # 只统计顶层导入
+            modules[name.strip()] = int(cumulative) / 1e6
+    return elapsed, modules
+
+
+def bench_startup(args):
+    """统计各场景的启动耗时"""
+    for name, code in STARTUP_SCENARIOS.items():
+        runs = [run_importtime(code) for _ in range(args.repeat)]
+        elapsed, modules = min(runs, key=lambda run: run[0])
+        slowest = sorted(modules.items(), key=lambda item: -item[1])[:4]
+        print(u'%-7s 启动%.3f秒 导入%.3f秒 最慢: %s' %
+              (name, elapsed, sum(modules.values()), ', '.join(
+                  '%s %.3f' % item for item in slowest)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'微博抓取与词云生成的性能测试')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    parse_parser = subparsers.add_parser('parse', help=u'每条微博的解析耗时')
+    parse_parser.add_argument('--pages', help=u'保存的主页页面目录(*.html)')
+    parse_parser.add_argument('--repeat', type=int, default=5)
+    parse_parser.set_defaults(func=bench_parse)
+    segment_parser = subparsers.add_parser('segment', help=u'分词耗时')
+    segment_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    segment_parser.add_argument('--repeat', type=int, default=10)
+    segment_parser.set_defaults(func=bench_segment)
+    layout_parser = subparsers.add_parser('layout', help=u'词云排布耗时')
+    layout_parser.add_argument('--sizes', default='1,2,3')
+    layout_parser.add_argument('--max-words', type=int, default=150)
+    layout_parser.add_argument('--grid', type=int, default=4)
+    layout_parser.set_defaults(func=bench_layout)
+    startup_parser = subparsers.add_parser('startup', help=u'启动耗时')
+    startup_parser.add_argument('--repeat', type=int, default=3)
+    startup_parser.set_defaults(func=bench_startup)
+    suite_parser = subparsers.add_parser('suite', help=u'用模拟服务器测试抓取和生成图片')
+    suite_parser.add_argument('--fixtures', help=u'录制的页面目录，默认由自带数据生成')
+    suite_parser.add_argument('--latency', type=float, default=0)
+    suite_parser.add_argument('--error-rate', type=float, default=0)
+    suite_parser.add_argument('--only', help=u'只运行这些测试，逗号分隔')
+    suite_parser.add_argument('--output',
+                              default=os.path.join(BASE_DIR, 'bench_output.json'))
+    suite_parser.set_defaults(func=bench_suite)
+    stub_parser = subparsers.add_parser('stub', help=u'运行模拟服务器')
+    stub_parser.add_argument('--port', type=int, default=8000)
+    stub_parser.add_argument('--fixtures')
+    stub_parser.add_argument('--latency', type=float, default=0)
+    stub_parser.add_argument('--error-rate', type=float, default=0)
+    stub_parser.set_defaults(func=bench_stub)
+    record_parser = subparsers.add_parser('record', help=u'从weibo.cn录制页面')
+    record_parser.add_argument('--user-id', required=True)
+    record_parser.add_argument('--cookie', required=True)
+    record_parser.add_argument('--pages', type=int, default=3)
+    record_parser.add_argument('--base-url', default='https://weibo.cn')
+    record_parser.add_argument('--output', default=os.path.join(BASE_DIR, 'fixtures'))
+    record_parser.set_defaults(func=bench_record)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,32 +3,710 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import argparse
 import codecs
+import contextlib
 import copy
 import csv
+import hashlib
+import heapq
+import importlib
+import io
 import json
 import os
 import random
 import re
+import shutil
+import sqlite3
 import sys
+import threading
 import traceback
-from collections import OrderedDict
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from functools import lru_cache
+from urllib.parse import parse_qs, urlparse
 from time import sleep
+import time
+
+
+class LazyModule(object):
+    """延迟导入的模块，第一次访问属性时才导入。只抓取或只生成图片时，
+    不会导入用不到的第三方库"""
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
 
-import requests
-from lxml import etree
-from requests.adapters import HTTPAdapter
-from tqdm import tqdm
+
+# 抓取微博
+requests = LazyModule('requests')
+etree = LazyModule('lxml.etree')
 
 # 提取关键微博信息
-from wordcloud import WordCloud, STOPWORDS
-from imageio import imread
-import jieba
+wordcloud = LazyModule('wordcloud')
+imageio = LazyModule('imageio.v2')
+np = LazyModule('numpy')
+jieba = LazyModule('jieba')
 
 # 文本信息插入图片
-from PIL import Image, ImageDraw, ImageFont
-import time
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+
+
+class Metrics(object):
+    """运行指标：各阶段的次数和耗时，以及请求数、字节数、被捕获的异常数等计数，
+    可输出为json摘要或Prometheus文本格式。线程安全"""
+    # Prometheus中各计数的标签名称
+    label_names = {'errors': 'stage', 'http_status': 'code', 'render_cache': 'result'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清空指标"""
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}  # 阶段 -> [次数, 总耗时, 最大耗时]
+            self.counters = Counter()  # (名称, 标签) -> 计数
+
+    def observe(self, stage, seconds):
+        """记录一次阶段耗时"""
+        with self.lock:
+            stat = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """统计with块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def incr(self, name, value=1, label=''):
+        """增加计数"""
+        with self.lock:
+            self.counters[name, label] += value
+
+    def snapshot(self):
+        """返回可序列化的指标，可用merge合并到其他进程的指标中"""
+        with self.lock:
+            return {
+                'stages': {stage: list(stat)
+                           for stage, stat in self.stages.items()},
+                'counters': [[name, label, value] for (name, label), value
+                             in self.counters.items()],
+            }
+
+    def merge(self, snapshot):
+        """合并子进程的指标"""
+        with self.lock:
+            for stage, (count, total, longest) in snapshot['stages'].items():
+                stat = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                stat[0] += count
+                stat[1] += total
+                stat[2] = max(stat[2], longest)
+            for name, label, value in snapshot['counters']:
+                self.counters[name, label] += value
+
+    def summary(self):
+        """json摘要"""
+        snapshot = self.snapshot()
+        counters = OrderedDict()
+        for name, label, value in sorted(snapshot['counters']):
+            if label:
+                counters.setdefault(name, OrderedDict())[label] = value
+            else:
+                counters[name] = value
+        return OrderedDict([
+            ('started', datetime.fromtimestamp(
+                self.started).strftime('%Y-%m-%d %H:%M:%S')),
+            ('elapsed', round(time.time() - self.started, 3)),
+            ('stages', OrderedDict(
+                (stage, OrderedDict([('count', count),
+                                     ('seconds', round(total, 4)),
+                                     ('max', round(longest, 4))]))
+                for stage, (count, total, longest) in sorted(
+                    snapshot['stages'].items(), key=lambda item: -item[1][1]))),
+            ('counters', counters),
+        ])
+
+    def to_prometheus(self):
+        """Prometheus文本格式"""
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE weibo_stage_seconds summary',
+        ]
+        for stage, (count, total, longest) in sorted(snapshot['stages'].items()):
+            lines.append('weibo_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+            lines.append('weibo_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        lines.append('# TYPE weibo_stage_seconds_max gauge')
+        for stage, (count, total, longest) in sorted(snapshot['stages'].items()):
+            lines.append('weibo_stage_seconds_max{stage="%s"} %f' % (stage, longest))
+        names = sorted(set(name for name, _, _ in snapshot['counters']))
+        for name in names:
+            lines.append('# TYPE weibo_%s_total counter' % name)
+            for counter, label, value in sorted(snapshot['counters']):
+                if counter != name:
+                    continue
+                labels = '{%s="%s"}' % (self.label_names.get(
+                    name, 'label'), label) if label else ''
+                lines.append('weibo_%s_total%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        """写入json摘要和Prometheus文本文件(先写临时文件再替换)"""
+        for path, content in [
+            (json_path, lambda: json.dumps(self.summary(), ensure_ascii=False,
+                                           indent=2)),
+            (prometheus_path, self.to_prometheus),
+        ]:
+            if path:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(content())
+                os.replace(path + '.tmp', path)
+
+
+metrics = Metrics()  # 本进程的运行指标
+
+
+def report_error(stage, e):
+    """打印被捕获的异常并按阶段计数"""
+    metrics.incr('errors', label=stage)
+    print('Error: ', e)
+    traceback.print_exc()
+
+
+class TokenBucket(object):
+    """令牌桶限速器，rate为每秒补充的令牌数，burst为桶容量"""
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取出一个令牌，令牌不足时阻塞等待，返回等待的秒数"""
+        waited = 0.0
+        if self.rate <= 0:  # rate为0表示不限速
+            return waited
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+    def available(self):
+        """当前可用的令牌数(不取出)"""
+        if self.rate <= 0:
+            return self.burst
+        with self.lock:
+            return min(self.burst, self.tokens +
+                       (time.monotonic() - self.updated) * self.rate)
+
+
+class IdentityExhausted(Exception):
+    """全部cookie都已失效"""
+
+
+class Identity(object):
+    """身份池中的一个cookie：独立的令牌桶、健康分(请求成功率的滑动平均)和冷却状态"""
+    def __init__(self, cookie, rate, burst):
+        self.cookie = cookie
+        self.headers = {'Cookie': cookie}  # 整个cookie字符串作为请求头发送
+        self.key = hashlib.sha1(cookie.encode('utf-8')).hexdigest()[:16]
+        self.bucket = TokenBucket(rate, burst)
+        self.score = 1.0  # 健康分，0~1
+        self.failures = 0  # 连续失败次数
+        self.strikes = 0  # 连续冷却次数，决定下次冷却时长
+        self.cooldown_until = 0.0
+        self.dead = False  # 返回登录页，cookie错误或已过期
+
+
+class IdentityPool(object):
+    """cookie身份池：每个cookie单独限速，按健康分和剩余令牌选择身份；
+    连续失败或被限流的身份冷却一段时间(指数增长)，返回登录页的身份不再使用"""
+    def __init__(self,
+                 cookies,
+                 rate=0.5,
+                 burst=5,
+                 max_failures=3,
+                 cooldown=60,
+                 max_cooldown=900):
+        self.identities = [Identity(cookie, rate, burst) for cookie in cookies]
+        self.max_failures = max_failures  # 连续失败多少次后冷却
+        self.cooldown = cooldown  # 首次冷却的秒数
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.identities)
+
+    def alive(self):
+        """尚未失效的身份"""
+        return [identity for identity in self.identities if not identity.dead]
+
+    def acquire(self):
+        """选择一个可用身份并取出其令牌，全部身份冷却中时等待最早结束的冷却，
+        全部失效时抛出IdentityExhausted"""
+        while True:
+            with self.lock:
+                alive = self.alive()
+                if not alive:
+                    raise IdentityExhausted(u'全部cookie错误或已过期')
+                now = time.monotonic()
+                ready = [
+                    identity for identity in alive
+                    if identity.cooldown_until <= now
+                ]
+                if ready:
+                    # 优先选择剩余令牌多、健康分高的身份，把请求分散到各个cookie
+                    identity = max(ready, key=lambda i: i.bucket.available() * i.score)
+                else:
+                    delay = min(identity.cooldown_until
+                                for identity in alive) - now
+            if ready:
+                waited = identity.bucket.acquire()
+                if waited:
+                    metrics.observe('rate_limit_sleep', waited)
+                return identity
+            metrics.observe('identity_wait', delay)
+            sleep(delay)
+
+    def success(self, identity):
+        """记录一次成功的请求"""
+        with self.lock:
+            identity.score = identity.score * 0.9 + 0.1
+            identity.failures = 0
+            identity.strikes = 0
+
+    def failure(self, identity, reason, cooldown=False):
+        """记录一次失败的请求，cooldown为True(被限流)时冷却该身份；连续失败次数达到上限
+        且还有其他可用身份时也冷却该身份，只剩一个身份时由调用方重试"""
+        metrics.incr('identity_failures', label=reason)
+        with self.lock:
+            identity.score *= 0.9
+            identity.failures += 1
+            if cooldown or (identity.failures >= self.max_failures
+                            and len(self.alive()) > 1):
+                delay = min(self.max_cooldown,
+                            self.cooldown * 2**identity.strikes)
+                identity.cooldown_until = time.monotonic() + delay
+                identity.failures = 0
+                identity.strikes += 1
+                metrics.incr('identity_cooldowns')
+                print(u'cookie %s 暂停使用%d秒(%s)' % (identity.key, delay, reason))
+
+    def kill(self, identity):
+        """登录页说明cookie错误或已过期，不再使用该身份"""
+        with self.lock:
+            if identity.dead:
+                return
+            identity.dead = True
+        metrics.incr('identity_failures', label='login')
+        print(u'cookie %s 错误或已过期，已停用，剩余%d个可用' %
+              (identity.key, len(self.alive())))
+
+
+class ResponseCache(object):
+    """weibo.cn页面的磁盘缓存：按url和cookie身份寻址，zlib压缩存储，超出容量时按最近访问时间淘汰"""
+    # 各类页面的缓存有效期(秒)，None代表永久有效(长微博全文发布后不会变化)
+    ttls = [('/comment/', None), ('/info', 24 * 3600), ('/profile', 10 * 60)]
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, offline=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline  # 离线模式只读缓存，不访问网络
+        self.size = None  # 缓存占用的字节数，第一次写入时统计
+        self.lock = threading.Lock()
+
+    def get_path(self, url, identity):
+        """获取url对应的缓存文件路径"""
+        key = hashlib.sha1((identity + '\n' + url).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_ttl(self, url):
+        """获取url对应的缓存有效期"""
+        for pattern, ttl in self.ttls:
+            if pattern in url:
+                return ttl
+        return self.ttls[-1][1]
+
+    def get(self, url, identity):
+        """读取缓存，缓存不存在或已过期时返回None；离线模式下忽略有效期"""
+        path = self.get_path(url, identity)
+        try:
+            stat = os.stat(path)
+            ttl = self.get_ttl(url)
+            now = time.time()
+            if (not self.offline and ttl is not None
+                    and now - stat.st_mtime > ttl):
+                return None
+            with open(path, 'rb') as f:
+                content = zlib.decompress(f.read())
+            os.utime(path, (now, stat.st_mtime))  # 记录访问时间用于淘汰
+            return content
+        except (OSError, zlib.error):
+            return None
+
+    def set(self, url, identity, content):
+        """写入缓存"""
+        path = self.get_path(url, identity)
+        data = zlib.compress(content)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self.get_entries())
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def get_entries(self):
+        """列出缓存文件的(访问时间, 路径, 大小)"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, path, stat.st_size))
+        return entries
+
+    def evict(self):
+        """按最近访问时间淘汰缓存，直到占用不超过容量的90%"""
+        entries = sorted(self.get_entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class Fetcher(object):
+    """页面抓取层：共享keep-alive连接池，从cookie身份池中选择身份并按身份限速，
+    遇到登录页或被限流时换用其他身份重试，并提供预取线程池"""
+    # 被限流或拒绝访问时返回的状态码
+    blocked_status = (403, 418, 429)
+    # 未登录时weibo.cn返回的登录页标题
+    login_title = re.compile(r'<title>\s*(?:登录 - 新|新浪通行证)'.encode('utf-8'))
+
+    def __init__(self,
+                 cookies=None,
+                 rate=0.5,
+                 burst=5,
+                 workers=4,
+                 long_workers=2,
+                 retries=3,
+                 timeout=10,
+                 pool_size=None,
+                 cache=None,
+                 retry_budget=30):
+        self.rate = rate  # 每个cookie每秒允许的请求数
+        self.burst = burst  # 每个cookie允许的突发请求数
+        self.workers = workers  # 预取线程数
+        self.long_workers = long_workers  # 获取长微博全文的线程数
+        self.timeout = timeout
+        self.cache = cache  # ResponseCache，为None时不缓存
+        self.retry_budget = retry_budget  # 本次运行剩余的重试次数，所有用户共用
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                              pool_maxsize=pool_size or workers + long_workers,
+                              max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.identities = IdentityPool(cookies or [''], rate, burst)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # 长微博全文失败时会退避等待，使用单独的线程池，不占用预取页面的线程
+        self.long_executor = ThreadPoolExecutor(max_workers=long_workers)
+
+    def is_login_page(self, response):
+        """是否被重定向到了登录页"""
+        return ('passport.weibo' in response.url
+                or self.login_title.search(response.content[:2048]) is not None)
+
+    def get(self, url):
+        """优先读取缓存，否则从身份池选择身份限速后通过共享会话获取页面内容。
+        身份返回登录页时停用该身份，被限流时冷却该身份，然后换用其他身份重试"""
+        if self.cache:
+            for identity in self.identities.identities:
+                content = self.cache.get(url, identity.key)
+                if content is not None:
+                    metrics.incr('cache_hits')
+                    return content
+            if self.cache.offline:
+                raise IOError(u'离线模式下缓存中没有%s' % url)
+        for attempt in range(len(self.identities)):
+            identity = self.identities.acquire()
+            try:
+                with metrics.timer('fetch'):
+                    response = self.session.get(url,
+                                                headers=identity.headers,
+                                                timeout=self.timeout)
+            except Exception:
+                self.identities.failure(identity, 'error')
+                raise
+            metrics.incr('requests')
+            metrics.incr('fetch_bytes', len(response.content))
+            metrics.incr('http_status', label=str(response.status_code))
+            if response.status_code in self.blocked_status:
+                self.identities.failure(identity, 'blocked', cooldown=True)
+                continue
+            if self.is_login_page(response):
+                self.identities.kill(identity)
+                continue
+            if response.status_code >= 500:
+                self.identities.failure(identity, 'error')
+            else:
+                self.identities.success(identity)
+            if self.cache and response.status_code == 200:
+                self.cache.set(url, identity.key, response.content)
+            return response.content
+        if not self.identities.alive():
+            raise IdentityExhausted(u'全部cookie错误或已过期')
+        return response.content
+
+    def take_retry(self):
+        """消耗一次重试机会，预算用完时返回False"""
+        with self.lock:
+            if self.retry_budget <= 0:
+                metrics.incr('retry_budget_exhausted')
+                return False
+            self.retry_budget -= 1
+        metrics.incr('retries')
+        return True
+
+    def backoff(self, attempt, base=1, cap=30):
+        """第attempt次重试前按指数退避随机等待"""
+        delay = random.uniform(0, min(cap, base * 2**attempt))
+        metrics.observe('retry_sleep', delay)
+        sleep(delay)
+
+    def submit(self, fn, *args):
+        """将任务提交到预取线程池"""
+        return self.executor.submit(fn, *args)
+
+    def submit_long(self, fn, *args):
+        """将获取长微博全文的任务提交到长微博线程池"""
+        return self.long_executor.submit(fn, *args)
+
+    def close(self):
+        """关闭线程池和连接池"""
+        self.executor.shutdown(wait=False)
+        self.long_executor.shutdown(wait=False)
+        self.session.close()
+
+
+class CsvSink(object):
+    """按用户打开一次的csv输出：缓冲写入临时文件，按条数或时间刷新，
+    close时再替换正式文件，程序中途退出不会留下写了一半的csv"""
+    def __init__(self, path, headers, flush_rows=100, flush_seconds=5):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        if os.path.isfile(path):  # 在已有数据之后追加
+            shutil.copyfile(path, self.tmp_path)
+        elif os.path.isfile(self.tmp_path):  # 上次中途退出留下的临时文件
+            os.remove(self.tmp_path)
+        self.file = open(self.tmp_path,
+                         'a',
+                         encoding='utf-8-sig',
+                         newline='',
+                         buffering=64 * 1024)
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:  # 新文件才写表头
+            self.writer.writerow(headers)
+        self.updates = {}  # 要替换的已有行，微博id -> 新的行
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.count = 0  # 本次写入的条数
+
+    def write(self, row):
+        """写入一行，缓冲的行数或距上次刷新的时间超过限制时刷新到磁盘"""
+        self.buffer.append(row)
+        self.count += 1
+        if (len(self.buffer) >= self.flush_rows or
+                time.monotonic() - self.last_flush >= self.flush_seconds):
+            self.flush()
+
+    def update(self, row):
+        """替换已有的同一微博的行(如补全了全文的长微博)，close时生效"""
+        self.updates[row[0]] = row
+        self.count += 1
+
+    def flush(self):
+        """将缓冲的行写入临时文件并同步到磁盘"""
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """刷新剩余数据，替换要更新的行，用临时文件替换正式文件"""
+        self.flush()
+        self.file.close()
+        if self.updates:
+            with open(self.tmp_path, encoding='utf-8-sig', newline='') as f:
+                rows = [self.updates.get(row[0], row) if row else row
+                        for row in csv.reader(f)]
+            with open(self.tmp_path, 'w', encoding='utf-8-sig', newline='') as f:
+                csv.writer(f).writerows(rows)
+        os.replace(self.tmp_path, self.path)
+
+
+class SqliteSink(object):
+    """按用户打开一次的SQLite输出：发布时间和互动数为带类型的列并建有索引，
+    可按列和时间范围读取；同一微博重复写入时覆盖旧数据。新建数据库时先导入seed_path
+    (已有的csv)中的全部微博，增量爬取只写入新微博，数据库也包含之前的数据"""
+    def __init__(self, path, flush_rows=100, seed_path=None):
+        self.path = path
+        self.flush_rows = flush_rows
+        created = not os.path.isfile(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS weibo ('
+                          'id TEXT PRIMARY KEY, content TEXT, '
+                          'publish_place TEXT, publish_time TEXT, '
+                          'publish_tool TEXT, up_num INTEGER, '
+                          'retweet_num INTEGER, comment_num INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS weibo_publish_time '
+                          'ON weibo (publish_time)')
+        if created and seed_path and os.path.isfile(seed_path):
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO weibo VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    read_rows(seed_path))
+        self.buffer = []
+        self.count = 0
+
+    def write(self, row):
+        """写入一行，缓冲的行数超过限制时提交"""
+        self.buffer.append(row)
+        self.count += 1
+        if len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """在一个事务中提交缓冲的行"""
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO weibo VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                self.buffer)
+        self.buffer = []
+
+    def close(self):
+        """提交剩余数据并关闭连接"""
+        self.flush()
+        self.conn.close()
+
+
+class WeiboRecord(object):
+    """一条微博的信息，fields的顺序即写入文件的列顺序"""
+    fields = ('id', 'content', 'publish_place', 'publish_time',
+              'publish_tool', 'up_num', 'retweet_num', 'comment_num')
+    headers = ('微博id', '微博正文', '发布位置', '发布时间', '发布工具', '点赞数',
+               '转发数', '评论数')  # csv表头，与fields一一对应
+    # publish_datetime为解析后的发布时间；long_weibo为待获取的全文(链接, 是否原创,
+    # 转发理由前缀)；truncated代表全文获取失败，content为截断的内容；
+    # retried代表上次全文获取失败、本次重新获取的微博，写入时替换已保存的行
+    __slots__ = fields + ('publish_datetime', 'long_weibo', 'truncated',
+                          'retried')
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def values(self):
+        """按列顺序返回各字段的值"""
+        return [getattr(self, key) for key in self.fields]
+
+
+class EngagementIndex(object):
+    """互动数索引：按发布日期分桶，每天分别保存点赞、转发、评论数最多的k条微博，
+    抓取时随写入更新。查询最近若干天的top n只需合并这些天的桶，不用重新读取全部数据"""
+    metrics = ('up_num', 'retweet_num', 'comment_num')
+
+    def __init__(self, path, k=10):
+        self.path = path
+        self.k = k
+        self.days = {}  # 日期 -> {指标: [[互动数, 发布时间, 微博id, 微博正文], ...]}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('k', 0) >= k:
+                self.k = index['k']
+                self.days = index['days']
+        self.count = 0
+
+    def write(self, row):
+        """加入一条微博，row的列顺序同WeiboRecord.fields；同一微博再次加入时更新互动数"""
+        weibo_id, content, publish_time = row[0], row[1].strip(), row[3]
+        buckets = self.days.setdefault(publish_time[:10], {})
+        for i, metric in enumerate(self.metrics):
+            bucket = [
+                entry for entry in buckets.get(metric, [])
+                if entry[2] != weibo_id
+            ]
+            bucket.append([int(row[5 + i]), publish_time, weibo_id, content])
+            bucket.sort(reverse=True)
+            buckets[metric] = bucket[:self.k]
+        self.count += 1
+
+    def top(self, n, metric='up_num', since_date=None):
+        """返回since_date(yyyy-mm-dd)以来metric最多的n条微博(n不超过k)，
+        每条为(微博正文, 发布时间, 互动数, 微博id)"""
+        entries = [
+            entry for day, buckets in self.days.items()
+            if not since_date or day >= since_date[:10]
+            for entry in buckets.get(metric, [])
+        ]
+        return [(entry[3], entry[1], entry[0], entry[2])
+                for entry in heapq.nlargest(n, entries)]
+
+    def close(self):
+        """保存索引(先写临时文件再替换，临时文件按线程区分)"""
+        tmp_path = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'k': self.k, 'days': self.days}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
 
 class Weibo(object):
     def __init__(self, config):
@@ -41,12 +719,37 @@ class Weibo(object):
             since_date = str(date.today() - timedelta(int(since_date)))
         self.since_date = since_date  # 起始时间，即爬取发布日期从该值到现在的微博，形式为yyyy-mm-dd
         self.write_mode = config[
-            'write_mode']  # 结果信息保存类型，为list形式，可包含txt、csv、json、mongo和mysql五种类型
+            'write_mode']  # 结果信息保存类型，为list形式，可包含txt、csv、sqlite、json、mongo和mysql六种类型
         self.pic_download = config[
             'pic_download']  # 取值范围为0、1,程序默认值为0,代表不下载微博原始图片,1代表下载
         self.video_download = config[
             'video_download']  # 取值范围为0、1,程序默认为0,代表不下载微博视频,1代表下载
-        self.cookie = {'Cookie': config['cookie']}
+        cookies = config['cookie']  # 一个cookie或cookie列表，多个cookie时轮换使用并自动切换
+        if not isinstance(cookies, list):
+            cookies = [cookies]
+        self.base_url = config.get('base_url', 'https://weibo.cn').rstrip(
+            '/')  # 微博地址，测试时可指向本地的模拟服务器
+        self.incremental = config.get(
+            'incremental', 1)  # 取值范围为0、1,默认为1,代表从上次爬取到的最新微博处继续增量爬取
+        self.concurrency = config.get('concurrency', 1)  # 同时爬取的用户数,1为逐个爬取
+        workers = config.get('workers', 4)  # 预取页面的线程数
+        long_workers = config.get('long_workers', 2)  # 获取长微博全文的线程数
+        cache = None
+        if config.get('cache_dir'):  # 页面缓存目录，不填则不缓存
+            cache = ResponseCache(
+                config['cache_dir'],
+                max_bytes=config.get('cache_size', 200) * 1024 * 1024,
+                offline=config.get('offline', 0))  # 1代表只使用缓存，不访问网络
+        self.fetcher = Fetcher(
+            cookies=cookies,
+            rate=config.get('rate_limit', 0.5),  # 每个cookie每秒请求数,0为不限速
+            burst=config.get('burst', 5),
+            workers=workers,
+            long_workers=long_workers,
+            pool_size=workers + long_workers + self.concurrency,
+            cache=cache,
+            retry_budget=config.get('retry_budget', 30))  # 长微博全文的重试次数上限
+
         self.mysql_config = config.get('mysql_config')  # MySQL数据库连接配置，可以不填
         user_id_list = config['user_id_list']
         if not isinstance(user_id_list, list):
@@ -67,8 +770,20 @@ class Weibo(object):
         self.start_time = ''  # 获取用户第一条微博时的时间
         self.user = {}  # 存储爬取到的用户信息
         self.got_num = 0  # 存储爬取到的微博数
-        self.weibo = []  # 存储爬取到的所有微博信息
-        self.weibo_id_list = []  # 存储爬取到的所有微博id
+        self.weibo = []  # 存储爬取到、尚未写入文件的微博信息
+        self.newest_weibos = []  # 本次爬取到的发布时间最新的微博
+        self.sinks = {}  # 当前用户各write_mode的输出
+        self.weibo_ids = set()  # 存储爬取到的所有微博id
+        self.long_weibo_futures = deque()  # 正在获取全文的长微博
+        self.truncated_num = 0  # 全文获取失败的长微博数
+        self.truncated_weibos = []  # 全文获取失败的长微博(各列的值, 全文信息)，下次运行时重新获取
+        self.since_time = None  # 解析后的since_date
+        self.checkpoint = {}  # 上次爬取的断点,包含最新微博的id和发布时间
+        self.checkpoint_active = False  # 断点是否覆盖本次的since_date
+        self.checkpoint_time = None  # 解析后的断点发布时间
+        self.page_cache = {}  # 查找页数时已获取的页面
+        self.failed_pages = []  # 获取或解析失败的页码
+        self.crawled = OrderedDict()  # 已爬取的用户，输入的用户id -> (用户id, 昵称)
 
     def validate_config(self, config):
         """验证配置是否正确"""
@@ -85,13 +800,13 @@ class Weibo(object):
             sys.exit(u'since_date值应为yyyy-mm-dd形式或整数,请重新输入')
 
         # 验证write_mode
-        write_mode = ['txt', 'csv', 'json', 'mongo', 'mysql']
+        write_mode = ['txt', 'csv', 'sqlite', 'json', 'mongo', 'mysql']
         if not isinstance(config['write_mode'], list):
             sys.exit(u'write_mode值应为list类型')
         for mode in config['write_mode']:
             if mode not in write_mode:
                 sys.exit(
-                    u'%s为无效模式，请从txt、csv、json、mongo和mysql中挑选一个或多个作为write_mode' %
+                    u'%s为无效模式，请从txt、csv、sqlite、json、mongo和mysql中挑选一个或多个作为write_mode' %
                     mode)
 
         # 验证user_id_list
@@ -128,37 +843,40 @@ class Weibo(object):
     def handle_html(self, url):
         """处理html"""
         try:
-            html = requests.get(url, cookies=self.cookie).content
-            selector = etree.HTML(html)
+            html = self.fetcher.get(url)
+            with metrics.timer('parse_html'):
+                selector = etree.HTML(html)
             return selector
+        except IdentityExhausted:
+            raise  # 全部cookie失效时停止爬取，不当作单个页面的错误
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('handle_html', e)
 
     def handle_garbled(self, info):
         """处理乱码"""
         try:
-            info = (info.xpath('string(.)').replace(u'\u200b', '').encode(
-                sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding))
-            return info
+            return self.normalize_text(info.xpath('string(.)'))
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('handle_garbled', e)
+
+    def normalize_text(self, text):
+        """去除零宽字符及终端无法显示的字符"""
+        encoding = sys.stdout.encoding or 'utf-8'
+        return text.replace(u'\u200b', '').encode(encoding,
+                                                   'ignore').decode(encoding)
 
     def get_nickname(self):
         """获取用户昵称"""
         try:
-            url = 'https://weibo.cn/%s/info' % (self.user_config['user_id'])
+            url = '%s/%s/info' % (self.base_url, self.user_config['user_id'])
             selector = self.handle_html(url)
             nickname = selector.xpath('//title/text()')[0]
             nickname = nickname[:-3]
-            if nickname == u'登录 - 新' or nickname == u'新浪':
-                self.write_log()
-                sys.exit(u'cookie错误或已过期,请按照README中方法重新获取')
             return nickname
+        except IdentityExhausted:
+            raise
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_nickname', e)
 
     def get_user_id(self, selector):
         """获取用户id，使用者输入的user_id不一定是正确的，可能是个性域名等，需要获取真正的user_id"""
@@ -188,9 +906,10 @@ class Weibo(object):
             self.print_user_info()
             print('*' * 100)
             return self.user
+        except IdentityExhausted:
+            raise
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_user_info', e)
 
     def get_page_num(self, selector):
         """获取微博总页数"""
@@ -202,108 +921,89 @@ class Weibo(object):
                     selector.xpath("//input[@name='mp']")[0].attrib['value'])
             return page_num
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_page_num', e)
 
     def get_long_weibo(self, weibo_link):
-        """获取长原创微博"""
-        try:
-            for i in range(5):
-                selector = self.handle_html(weibo_link)
+        """获取长原创微博，失败时指数退避重试，重试预算用完或5次都失败时返回None"""
+        for attempt in range(5):
+            try:
+                with metrics.timer('long_weibo_fetch'):
+                    selector = self.handle_html(weibo_link)
                 if selector is not None:
                     info = selector.xpath("//div[@class='c']")[1]
                     wb_content = self.handle_garbled(info)
                     wb_time = info.xpath("//span[@class='ct']/text()")[0]
-                    weibo_content = wb_content[wb_content.find(':') +
-                                               1:wb_content.rfind(wb_time)]
-                    if weibo_content is not None:
-                        return weibo_content
-                sleep(random.randint(6, 10))
-        except Exception as e:
-            return u'网络出错'
-            print('Error: ', e)
-            traceback.print_exc()
-
-    def get_original_weibo(self, info, weibo_id):
-        """获取原创微博"""
-        try:
-            weibo_content = self.handle_garbled(info)
-            weibo_content = weibo_content[:weibo_content.rfind(u'赞')]
-            a_text = info.xpath('div//a/text()')
-            if u'全文' in a_text:
-                weibo_link = 'https://weibo.cn/comment/' + weibo_id
-                wb_content = self.get_long_weibo(weibo_link)
-                if wb_content:
-                    weibo_content = wb_content
-            return weibo_content
-        except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+                    return wb_content[wb_content.find(':') +
+                                      1:wb_content.rfind(wb_time)]
+            except IdentityExhausted:
+                raise
+            except Exception as e:
+                report_error('get_long_weibo', e)
+            if attempt == 4 or not self.fetcher.take_retry():
+                return None
+            self.fetcher.backoff(attempt)
 
-    def get_long_retweet(self, weibo_link):
-        """获取长转发微博"""
-        try:
-            wb_content = self.get_long_weibo(weibo_link)
-            weibo_content = wb_content[:wb_content.rfind(u'原文转发')]
-            return weibo_content
-        except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
-
-    def get_retweet(self, info, weibo_id):
-        """获取转发微博"""
-        try:
-            weibo_content = self.handle_garbled(info)
-            weibo_content = weibo_content[weibo_content.find(':') +
-                                          1:weibo_content.rfind(u'赞')]
-            weibo_content = weibo_content[:weibo_content.rfind(u'赞')]
-            a_text = info.xpath('div//a/text()')
-            if u'全文' in a_text:
-                weibo_link = 'https://weibo.cn/comment/' + weibo_id
-                wb_content = self.get_long_retweet(weibo_link)
-                if wb_content:
-                    weibo_content = wb_content
-            retweet_reason = self.handle_garbled(info.xpath('div')[-1])
-            retweet_reason = retweet_reason[:retweet_reason.rindex(u'赞')]
-            original_user = info.xpath("div/span[@class='cmt']/a/text()")
-            if original_user:
-                original_user = original_user[0]
-                weibo_content = (retweet_reason + '\n' + u'原始用户: ' +
-                                 original_user + '\n' + u'转发内容: ' +
-                                 weibo_content)
+    def expand_long_weibos(self, wait=True):
+        """按顺序处理后台获取的长微博全文，获取失败时保留截断的内容并记录。
+        wait为False时遇到尚未完成的长微博即返回"""
+        while self.long_weibo_futures:
+            weibo, future = self.long_weibo_futures[0]
+            if not wait and not future.done():
+                break
+            self.long_weibo_futures.popleft()
+            weibo_link, is_original, prefix = weibo.long_weibo
+            wb_content = future.result()
+            if wb_content and not is_original:
+                wb_content = wb_content[:wb_content.rfind(u'原文转发')]
+            metrics.incr('long_weibos')
+            if wb_content:
+                weibo.content = prefix + wb_content
             else:
-                weibo_content = (retweet_reason + '\n' + u'转发内容: ' +
-                                 weibo_content)
-            return weibo_content
-        except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+                weibo.truncated = True
+                self.truncated_num += 1
+                self.truncated_weibos.append((weibo.values(), weibo.long_weibo))
+                metrics.incr('long_weibos_truncated')
+                print(u'长微博%s获取全文失败，保留截断的内容' % weibo.id)
+            weibo.long_weibo = None
 
-    def is_original(self, info):
-        """判断微博是否为原创微博"""
-        is_original = info.xpath("div/span[@class='cmt']")
-        if len(is_original) > 3:
-            return False
-        else:
-            return True
+    def retry_truncated(self):
+        """重新获取上次全文获取失败的长微博，获取成功后替换已保存的截断内容"""
+        try:
+            path = self.get_filepath('truncated')
+            if not os.path.isfile(path):
+                return
+            with open(path, encoding='utf-8') as f:
+                entries = json.load(f)
+            for values, long_weibo in entries:
+                weibo = WeiboRecord(**dict(zip(WeiboRecord.fields, values)))
+                weibo.long_weibo = tuple(long_weibo)
+                weibo.retried = True
+                self.weibo.append(weibo)
+                self.weibo_ids.add(weibo.id)
+                self.long_weibo_futures.append(
+                    (weibo,
+                     self.fetcher.submit_long(self.get_long_weibo,
+                                              long_weibo[0])))
+            print(u'重新获取%d条长微博的全文' % len(entries))
+        except Exception as e:
+            report_error('retry_truncated', e)
 
-    def get_weibo_content(self, info, is_original):
-        """获取微博内容"""
+    def save_truncated(self):
+        """保存本次全文获取失败的长微博，没有时删除记录文件"""
         try:
-            weibo_id = info.xpath('@id')[0][2:]
-            if is_original:
-                weibo_content = self.get_original_weibo(info, weibo_id)
-            else:
-                weibo_content = self.get_retweet(info, weibo_id)
-            return weibo_content
+            path = self.get_filepath('truncated')
+            if self.truncated_weibos:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(self.truncated_weibos, f, ensure_ascii=False)
+                os.replace(path + '.tmp', path)
+            elif os.path.isfile(path):
+                os.remove(path)
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('save_truncated', e)
 
-    def get_publish_place(self, info):
-        """获取微博发布位置"""
+    def parse_publish_place(self, div_first):
+        """从微博的第一个div中解析发布位置"""
         try:
-            div_first = info.xpath('div')[0]
             a_list = div_first.xpath('a')
             publish_place = u'无'
             for a in a_list:
@@ -322,14 +1022,16 @@ class Weibo(object):
                         break
             return publish_place
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('parse_publish_place', e)
 
     def get_publish_time(self, info):
         """获取微博发布时间"""
+        str_time = info.xpath("div/span[@class='ct']")
+        return self.parse_publish_time(self.handle_garbled(str_time[0]))
+
+    def parse_publish_time(self, str_time):
+        """从span.ct的文本中解析发布时间"""
         try:
-            str_time = info.xpath("div/span[@class='ct']")
-            str_time = self.handle_garbled(str_time[0])
             publish_time = str_time.split(u'来自')[0]
             if u'刚刚' in publish_time:
                 publish_time = datetime.now().strftime('%Y-%m-%d %H:%M')
@@ -354,8 +1056,7 @@ class Weibo(object):
                 publish_time = publish_time[:16]
             return publish_time
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('parse_publish_time', e)
 
     def print_user_info(self):
         """打印微博用户信息"""
@@ -364,29 +1065,24 @@ class Weibo(object):
         print(u'微博数: %d' % self.user['weibo_num'])
         print(u'关注数: %d' % self.user['following'])
         print(u'粉丝数: %d' % self.user['followers'])
-        print(u'url：https://weibo.cn/%s' % self.user['id'])
+        print(u'url：%s/%s' % (self.base_url, self.user['id']))
         
-    def get_publish_tool(self, info):
-        """获取微博发布工具"""
+    def parse_publish_tool(self, str_time):
+        """从span.ct的文本中解析发布工具"""
         try:
-            str_time = info.xpath("div/span[@class='ct']")
-            str_time = self.handle_garbled(str_time[0])
             if len(str_time.split(u'来自')) > 1:
                 publish_tool = str_time.split(u'来自')[1]
             else:
                 publish_tool = u'无'
             return publish_tool
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('parse_publish_tool', e)
 
-    def get_weibo_footer(self, info):
-        """获取微博点赞数、转发数、评论数"""
+    def parse_weibo_footer(self, str_footer):
+        """从最后一个div的文本中解析点赞数、转发数、评论数"""
         try:
             footer = {}
             pattern = r'\d+'
-            str_footer = info.xpath('div')[-1]
-            str_footer = self.handle_garbled(str_footer)
             str_footer = str_footer[str_footer.rfind(u'赞'):]
             weibo_footer = re.findall(pattern, str_footer, re.M)
 
@@ -400,8 +1096,7 @@ class Weibo(object):
             footer['comment_num'] = comment_num
             return footer
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('parse_weibo_footer', e)
 
     def get_picture_urls(self, info, is_original):
         """获取微博原始图片url"""
@@ -427,32 +1122,58 @@ class Weibo(object):
                 picture_urls['original_pictures'] = original_picture
             return picture_urls
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_picture_urls', e)
         
     def get_one_weibo(self, info):
-        """获取一条微博的全部信息"""
-        try:
-            weibo = OrderedDict()
-            is_original = self.is_original(info)
-            if (not self.filter) or is_original:
-                weibo['id'] = info.xpath('@id')[0][2:]
-                weibo['content'] = self.get_weibo_content(info,
-                                                          is_original)  # 微博内容
-                
-                weibo['publish_place'] = self.get_publish_place(info)  # 微博发布位置
-                weibo['publish_time'] = self.get_publish_time(info)  # 微博发布时间
-                weibo['publish_tool'] = self.get_publish_tool(info)  # 微博发布工具
-                footer = self.get_weibo_footer(info)
-                weibo['up_num'] = footer['up_num']  # 微博点赞数
-                weibo['retweet_num'] = footer['retweet_num']  # 转发数
-                weibo['comment_num'] = footer['comment_num']  # 评论数
+        """获取一条微博的全部信息，每个节点只遍历一次，文本只规范化一次"""
+        try:
+            cmt = info.xpath("div/span[@class='cmt']")
+            is_original = len(cmt) <= 3
+            if self.filter and not is_original:
+                return None
+            weibo_id = info.get('id')[2:]
+            divs = info.xpath('div')
+            text = self.normalize_text(info.xpath('string(.)'))
+            footer_text = self.normalize_text(divs[-1].xpath('string(.)'))
+            time_text = self.normalize_text(
+                info.xpath("string(div/span[@class='ct'])"))
+            if is_original:
+                prefix = ''
+                content = text[:text.rfind(u'赞')]
             else:
-                weibo = None
-            return weibo
+                content = text[text.find(':') + 1:text.rfind(u'赞')]
+                content = content[:content.rfind(u'赞')]
+                retweet_reason = footer_text[:footer_text.rindex(u'赞')]
+                original_user = [
+                    user for span in cmt for user in span.xpath('a/text()')
+                ]
+                if original_user:
+                    prefix = (retweet_reason + '\n' + u'原始用户: ' +
+                              original_user[0] + '\n' + u'转发内容: ')
+                else:
+                    prefix = retweet_reason + '\n' + u'转发内容: '
+                content = prefix + content
+            # 带“全文”链接的长微博先保存截断的内容，全文在整页解析后并发获取
+            long_weibo = None
+            if u'全文' in info.xpath('div//a/text()'):
+                long_weibo = (self.base_url + '/comment/' + weibo_id,
+                              is_original, prefix)
+            footer = self.parse_weibo_footer(footer_text)
+            publish_time = self.parse_publish_time(time_text)
+            return WeiboRecord(
+                id=weibo_id,
+                content=content,  # 微博内容
+                publish_place=self.parse_publish_place(divs[0]),  # 微博发布位置
+                publish_time=publish_time,  # 微博发布时间
+                publish_tool=self.parse_publish_tool(time_text),  # 微博发布工具
+                up_num=footer['up_num'],  # 微博点赞数
+                retweet_num=footer['retweet_num'],  # 转发数
+                comment_num=footer['comment_num'],  # 评论数
+                publish_datetime=self.str_to_time(publish_time),
+                long_weibo=long_weibo,
+                truncated=False)
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_one_weibo', e)
 
     def is_pinned_weibo(self, info):
         """判断微博是否为置顶微博"""
@@ -462,24 +1183,106 @@ class Weibo(object):
         else:
             return False
 
-    def get_one_page(self, page):
-        """获取第page页的全部微博"""
+    def get_page_url(self, page):
+        """获取第page页的url"""
+        return '%s/%s/profile?page=%d' % (self.base_url,
+                                          self.user_config['user_uri'], page)
+
+    def fetch_page(self, page):
+        """获取第page页，二分查找时已获取的页面直接复用。获取失败或返回错误页(如5xx)时
+        使用与长微博共用的重试预算指数退避重试，仍失败时返回最后一次的结果"""
+        selector = self.page_cache.pop(page, None)
+        attempt = 0
+        while True:
+            if selector is None:
+                selector = self.handle_html(self.get_page_url(page))
+            if selector is not None and selector.xpath("//div[@class='c']"):
+                return selector
+            if attempt == 4 or not self.fetcher.take_retry():
+                return selector
+            self.fetcher.backoff(attempt)
+            attempt += 1
+            selector = None
+
+    def get_page_time(self, page):
+        """获取第page页最早一条非置顶微博的发布时间，page超出实际页数时返回None。
+        页面获取失败或没有微博(如错误页)时抛出异常"""
+        if page not in self.page_cache:
+            self.page_cache[page] = self.fetch_page(page)
+        selector = self.page_cache[page]
+        if selector is None:
+            del self.page_cache[page]
+            raise ValueError(u'第%d页获取失败' % page)
+        info = selector.xpath("//div[@class='c']")
+        for i in range(len(info) - 3, -1, -1):
+            if (info[i].xpath("div/span[@class='ctt']")
+                    and not self.is_pinned_weibo(info[i])):
+                return self.str_to_time(self.get_publish_time(info[i]))
+        mp = selector.xpath("//input[@name='mp']/@value")
+        if mp and mp[0].isdigit() and page > int(mp[0]):
+            return None
+        del self.page_cache[page]  # 不缓存错误页，爬取时重新获取
+        raise ValueError(u'第%d页没有微博' % page)
+
+    def find_last_page(self, page_num):
+        """倍增后二分查找第一个跨过since_date(或上次断点)的页面，返回需要爬取的页数"""
         try:
-            url = 'https://weibo.cn/%s/profile?page=%d' % (
-                self.user_config['user_uri'], page)
-            selector = self.handle_html(url)
+            since_date = self.since_time
+            if self.checkpoint_active:
+                since_date = max(since_date, self.checkpoint_time)
+
+            def is_crossed(page):
+                publish_time = self.get_page_time(page)
+                return publish_time is None or publish_time < since_date
+
+            # lo页全部在时间范围内，hi页已跨过since_date
+            lo, hi, step = 1, page_num, 1
+            if is_crossed(lo):
+                hi = lo
+            while hi > lo:
+                probe = min(lo + step, page_num)
+                if is_crossed(probe):
+                    hi = probe
+                    break
+                lo = probe
+                step *= 2
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if is_crossed(mid):
+                    hi = mid
+                else:
+                    lo = mid
+            last_page = hi
+        except IdentityExhausted:
+            raise
+        except Exception as e:
+            report_error('is_crossed', e)
+            last_page = page_num  # 查找失败时逐页爬取，由get_one_page判断何时结束
+        for page in list(self.page_cache):  # 只保留会被爬取的页面
+            if page > last_page:
+                del self.page_cache[page]
+        return last_page
+
+    def get_one_page(self, page, selector=None):
+        """获取第page页的全部微博，selector为已预取的页面"""
+        try:
+            if selector is None:
+                selector = self.fetch_page(page)
+            metrics.incr('pages')
             info = selector.xpath("//div[@class='c']")
             is_exist = info[0].xpath("div/span[@class='ctt']")
             if is_exist:
                 for i in range(0, len(info) - 2):
-                    weibo = self.get_one_weibo(info[i])
+                    with metrics.timer('parse_weibo'):
+                        weibo = self.get_one_weibo(info[i])
                     if weibo:
-                        if weibo['id'] in self.weibo_id_list:
+                        if self.is_crawled(weibo):
+                            if self.is_pinned_weibo(info[i]):
+                                continue
+                            return True  # 之后的微博上次已经爬取过
+                        if weibo.id in self.weibo_ids:
                             continue
-                        publish_time = self.str_to_time(weibo['publish_time'])
-                        since_date = self.str_to_time(
-                            self.user_config['since_date'])
-                        if publish_time < since_date:
+                        if weibo.publish_datetime < self.since_time:
                             if self.is_pinned_weibo(info[i]):
                                 continue
                             else:
@@ -490,9 +1293,7 @@ class Weibo(object):
                                 """
                                 return True
                         #self.print_one_weibo(weibo)
-                        self.weibo.append(weibo)
-                        self.weibo_id_list.append(weibo['id'])
-                        self.got_num += 1
+                        self.add_weibo(weibo)
                         #print('-' * 100)
             """
             print(u'{}已获取{}({})的第{}页微博{}'.format('-' * 30,
@@ -500,22 +1301,112 @@ class Weibo(object):
                                                  self.user['id'], page,
                                                  '-' * 30))
              """
+        except IdentityExhausted:
+            raise
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_one_page', e)
+            self.failed_pages.append(page)
+
+    def add_weibo(self, weibo):
+        """保存一条新爬取到的微博，长微博开始在后台获取全文"""
+        self.weibo.append(weibo)
+        self.weibo_ids.add(weibo.id)
+        if weibo.long_weibo:
+            self.long_weibo_futures.append(
+                (weibo,
+                 self.fetcher.submit_long(self.get_long_weibo,
+                                          weibo.long_weibo[0])))
+        if (not self.newest_weibos or weibo.publish_datetime >
+                self.newest_weibos[0].publish_datetime):
+            self.newest_weibos = [weibo]
+        elif weibo.publish_datetime == self.newest_weibos[0].publish_datetime:
+            self.newest_weibos.append(weibo)
+        self.got_num += 1
+        metrics.incr('weibos')
+
+    def is_crawled(self, weibo):
+        """判断微博是否已在上次爬取时保存"""
+        if not self.checkpoint_active:
+            return False
+        if weibo.id in self.checkpoint['ids']:
+            return True
+        return weibo.publish_datetime < self.checkpoint_time
+
+    def load_checkpoint(self):
+        """读取爬取断点和已保存的微博id，断点需覆盖本次的since_date才会使用"""
+        self.checkpoint = {}
+        self.checkpoint_active = False
+        if not self.incremental:
+            return
+        try:
+            csv_path = self.get_filepath('csv')
+            db_path = self.get_filepath('db')
+            if os.path.isfile(csv_path):
+                with open(csv_path, encoding='utf-8-sig', newline='') as f:
+                    for row in csv.reader(f):
+                        if row and row[0] != '微博id':
+                            self.weibo_ids.add(row[0])
+            if os.path.isfile(db_path):
+                conn = sqlite3.connect(db_path)
+                self.weibo_ids.update(
+                    row[0] for row in conn.execute('SELECT id FROM weibo'))
+                conn.close()
+            checkpoint_path = self.get_filepath('checkpoint')
+            if not os.path.isfile(checkpoint_path):
+                return
+            with open(checkpoint_path, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            self.checkpoint = checkpoint
+            self.checkpoint_time = self.str_to_time(checkpoint['publish_time'])
+            if self.str_to_time(checkpoint['since_date']) <= self.since_time:
+                self.checkpoint_active = True
+                print(u'从上次爬取的最新微博(%s)处继续爬取' %
+                      checkpoint['publish_time'])
+        except Exception as e:
+            report_error('load_checkpoint', e)
+
+    def save_checkpoint(self):
+        """保存爬取断点：最新微博的发布时间及该时间发布的微博id"""
+        try:
+            checkpoint = dict(self.checkpoint)
+            if not checkpoint:
+                checkpoint = {
+                    'since_date': self.user_config['since_date'],
+                    'publish_time': self.user_config['since_date'],
+                    'ids': []
+                }
+            # 本次从since_date爬取到最新，与上次断点合并后覆盖两者中较早的起始时间
+            checkpoint['since_date'] = min(
+                checkpoint['since_date'],
+                self.user_config['since_date'],
+                key=self.str_to_time)
+            newest_time = self.str_to_time(checkpoint['publish_time'])
+            for weibo in self.newest_weibos:
+                if weibo.publish_datetime == newest_time:
+                    checkpoint['ids'].append(weibo.id)
+                elif weibo.publish_datetime > newest_time:
+                    newest_time = weibo.publish_datetime
+                    checkpoint['publish_time'] = weibo.publish_time
+                    checkpoint['ids'] = [weibo.id]
+            checkpoint['id'] = checkpoint['ids'][-1] if checkpoint[
+                'ids'] else ''
+            checkpoint_path = self.get_filepath('checkpoint')
+            with open(checkpoint_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f, ensure_ascii=False)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        except Exception as e:
+            report_error('save_checkpoint', e)
 
     def get_filepath(self, type):
         """获取结果文件路径"""
         try:
-            
             file_dir = self.user['nickname']
-            os.system('mkdir '+ file_dir )
+            os.makedirs(file_dir, exist_ok=True)
             file_path = file_dir + os.sep + self.user_config[
                 'user_id'] + '.' + type
             return file_path
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_filepath', e)
 
     def write_log(self):
         """当程序因cookie过期停止运行时，将相关信息写入log.txt"""
@@ -524,52 +1415,49 @@ class Weibo(object):
         if not os.path.isdir(file_dir):
             os.makedirs(file_dir)
         file_path = file_dir + 'log.txt'
-        content = u'cookie已过期，从%s到今天的微博获取失败，请重新设置cookie\n' % self.since_date
+        content = u'全部cookie已过期，从%s到今天的微博获取失败，请重新设置cookie\n' % self.since_date
         with open(file_path, 'ab') as f:
             f.write(content.encode(sys.stdout.encoding))
 
-    def write_csv(self, wrote_num):
+    def write_csv(self, weibos):
         """将爬取的信息写入csv文件"""
         try:
-            result_headers = [
-                '微博id',
-                '微博正文',
-                '原始图片url',
-                '微博视频url',
-                '发布位置',
-                '发布时间',
-                '发布工具',
-                '点赞数',
-                '转发数',
-                '评论数',
-            ]
-            if not self.filter:
-                result_headers.insert(3, '被转发微博原始图片url')
-                result_headers.insert(4, '是否为原创微博')
-            result_data = [w.values() for w in self.weibo[wrote_num:]]
-            if sys.version < '3':  # python2.x
-                reload(sys)
-                sys.setdefaultencoding('utf-8')
-                with open(self.get_filepath('csv'), 'ab') as f:
-                    f.write(codecs.BOM_UTF8)
-                    writer = csv.writer(f)
-                    if wrote_num == 0:
-                        writer.writerows([result_headers])
-                    writer.writerows(result_data)
-            else:  # python3.x
-                with open(self.get_filepath('csv'),
-                          'a',
-                          encoding='utf-8-sig',
-                          newline='') as f:
-                    writer = csv.writer(f)
-                    if wrote_num == 0:
-                        writer.writerows([result_headers])
-                    writer.writerows(result_data)
-            print(u'%d条微博写入csv文件完毕,保存路径:' % self.got_num)
-            print(self.get_filepath('csv'))
+            if 'csv' not in self.sinks:
+                self.sinks['csv'] = CsvSink(self.get_filepath('csv'),
+                                            WeiboRecord.headers)
+            with metrics.timer('write_csv'):
+                for w in weibos:
+                    if w.retried:
+                        self.sinks['csv'].update(w.values())
+                    else:
+                        self.sinks['csv'].write(w.values())
+        except Exception as e:
+            report_error('write_csv', e)
+
+    def write_sqlite(self, weibos):
+        """将爬取的信息写入SQLite数据库"""
+        try:
+            if 'sqlite' not in self.sinks:
+                self.sinks['sqlite'] = SqliteSink(
+                    self.get_filepath('db'), seed_path=self.get_filepath('csv'))
+            with metrics.timer('write_sqlite'):
+                for w in weibos:
+                    self.sinks['sqlite'].write(w.values())
+        except Exception as e:
+            report_error('write_sqlite', e)
+
+    def write_engagement(self, weibos):
+        """更新互动数索引"""
+        try:
+            if 'engagement' not in self.sinks:
+                data_path = self.get_filepath(
+                    'db' if 'sqlite' in self.write_mode else 'csv')
+                self.sinks['engagement'] = load_engagement_index(data_path)
+            with metrics.timer('write_engagement'):
+                for w in weibos:
+                    self.sinks['engagement'].write(w.values())
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('write_engagement', e)
 
     def update_user_config_file(self, user_config_file_path):
         """更新用户配置文件"""
@@ -595,52 +1483,85 @@ class Weibo(object):
         with codecs.open(user_config_file_path, 'w', encoding='utf-8') as f:
             f.write('\n'.join(lines))
 
-    def write_data(self, wrote_num):
-        """将爬取到的信息写入文件或数据库"""
-        if self.got_num > wrote_num:
+    def write_data(self, wait=True):
+        """将爬取到的信息写入文件或数据库，写入后不再保留在内存中。
+        wait为False时，还在获取全文的长微博及其后的微博留到下次写入"""
+        self.expand_long_weibos(wait)
+        ready = len(self.weibo)
+        if self.long_weibo_futures:
+            ready = self.weibo.index(self.long_weibo_futures[0][0])
+        if ready:
             if 'csv' in self.write_mode:
-                self.write_csv(wrote_num)
+                self.write_csv(self.weibo[:ready])
+            if 'sqlite' in self.write_mode:
+                self.write_sqlite(self.weibo[:ready])
+            self.write_engagement(self.weibo[:ready])
+            self.weibo = self.weibo[ready:]
+
+    def close_data(self):
+        """完成写入，用临时文件替换正式文件"""
+        for mode, sink in self.sinks.items():
+            sink.close()
+            print(u'%d条微博写入%s文件完毕,保存路径:' % (sink.count, mode))
+            print(sink.path)
+        self.sinks = {}
 
     def get_weibo_info(self):
         """获取微博信息"""
         try:
-            url = 'https://weibo.cn/%s/profile' % (self.user_config['user_uri'])
+            url = '%s/%s/profile' % (self.base_url, self.user_config['user_uri'])
             selector = self.handle_html(url)
             self.get_user_info(selector)  # 获取用户昵称、微博数、关注数、粉丝数
-            #page_num = self.get_page_num(selector)  # 获取微博总页数
-            page_num = 21
-            wrote_num = 0
-            page1 = 0
-            random_pages = random.randint(1, 5)
+            self.load_checkpoint()
+            self.retry_truncated()
+            page_num = self.get_page_num(selector) or 1  # 获取微博总页数
+            self.page_cache = {1: selector}
+            page_num = self.find_last_page(page_num)  # 只需爬取到跨过since_date的那一页
             self.start_time = datetime.now().strftime('%Y-%m-%d %H:%M')
-            #for page in tqdm(range(1, page_num + 1), desc='Progress'):
-            for page in range(1, page_num + 1):
-                is_end = self.get_one_page(page)  # 获取第page页的全部微博
+            # 预取后续页面，按页码顺序解析，遇到早于since_date的微博即停止并取消
+            # 未完成的预取。请求速度由Fetcher的令牌桶控制，不再随机等待
+            pages = iter(range(1, page_num + 1))
+            pending = deque()
+            for page in pages:
+                pending.append((page, self.fetcher.submit(self.fetch_page,
+                                                          page)))
+                if len(pending) >= self.fetcher.workers:
+                    break
+            while pending:
+                page, future = pending.popleft()
+                is_end = self.get_one_page(page, future.result())  # 获取第page页的全部微博
                 if is_end:
+                    for _, future in pending:
+                        future.cancel()
                     break
-
-                if page % 20 == 0:  # 每爬20页写入一次文件
-                    self.write_data(wrote_num)
-                    wrote_num = self.got_num
-
-                # 通过加入随机等待避免被限制。爬虫速度过快容易被系统限制(一段时间后限
-                # 制会自动解除)，加入随机等待模拟人的操作，可降低被系统限制的风险。默
-                # 认是每爬取1到5页随机等待6到10秒，如果仍然被限，可适当增加sleep时间
-                if (page - page1) % random_pages == 0 and page < page_num:
-                    sleep(random.randint(6, 10))
-                    page1 = page
-                    random_pages = random.randint(1, 5)
+                next_page = next(pages, None)
+                if next_page is not None:
+                    pending.append((next_page,
+                                    self.fetcher.submit(
+                                        self.fetch_page, next_page)))
+                self.write_data(wait=False)  # 每页解析完即写入文件
                 print("Finshed Deal Page：" + str(page) + '/'+ str(page_num))
 
-            self.write_data(wrote_num)  # 将剩余不足20页的微博写入文件
+            self.page_cache = {}
+            self.write_data()
+            self.close_data()
+            self.save_truncated()
+            if self.failed_pages:  # 断点之前不能有漏爬的微博，下次仍从原断点处继续
+                print(u'第%s页获取失败，未更新爬取断点' %
+                      ','.join(str(page) for page in self.failed_pages))
+            elif self.incremental:
+                self.save_checkpoint()
+            if self.truncated_num:
+                print(u'%d条长微博获取全文失败，已保存截断的内容' % self.truncated_num)
             if not self.filter:
                 print(u'共爬取' + str(self.got_num) + u'条微博')
             else:
                 print(u'共爬取' + str(self.got_num) + u'条原创微博')
     
+        except IdentityExhausted:
+            raise
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('get_weibo_info', e)
 
     def get_user_config_list(self, file_name):
         """获取文件中的微博id信息"""
@@ -671,57 +1592,521 @@ class Weibo(object):
         """初始化爬虫信息"""
         self.got_num = 0
         self.weibo = []
+        self.newest_weibos = []
+        self.sinks = {}
         self.user = {}
         self.user_config = user_config
-        self.weibo_id_list = []
+        self.since_time = self.str_to_time(user_config['since_date'])
+        self.weibo_ids = set()
+        self.long_weibo_futures = deque()
+        self.truncated_num = 0
+        self.truncated_weibos = []
+        self.checkpoint = {}
+        self.checkpoint_active = False
+        self.checkpoint_time = None
+        self.page_cache = {}
+        self.failed_pages = []
+
+    def crawl_user(self, user_config):
+        """用独立的爬虫副本爬取单个用户，副本与本对象共享抓取层和连接池"""
+        crawler = copy.copy(self)
+        crawler.initialize_info(user_config)
+        print('*' * 100)
+        crawler.get_weibo_info()
+        print(u'信息抓取完毕')
+        print('*' * 100)
+        return crawler
+
+    async def crawl_users(self):
+        """在concurrency个线程中同时爬取多个用户(爬取本身是阻塞的，并发数由线程池限制)，
+        事件循环只负责等待结果并在同一线程中依次更新配置文件"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        async def crawl(user_config):
+            crawler = await loop.run_in_executor(executor, self.crawl_user,
+                                                 user_config)
+            # 配置文件只在事件循环线程中更新，避免多个用户同时写文件
+            if self.user_config_file_path:
+                crawler.update_user_config_file(self.user_config_file_path)
+            return crawler
+
+        try:
+            return await asyncio.gather(
+                *[crawl(user_config) for user_config in self.user_config_list])
+        finally:
+            executor.shutdown(wait=False)
 
     def start(self):
         """运行爬虫"""
         try:
+            if self.concurrency > 1 and len(self.user_config_list) > 1:
+                import asyncio  # 只有同时爬取多个用户时才需要，不拖慢启动
+                crawlers = asyncio.run(self.crawl_users())
+                for crawler in crawlers:
+                    self.crawled[crawler.user_config['user_uri']] = (
+                        crawler.user_config.get('user_id'),
+                        crawler.user.get('nickname'))
+                last = crawlers[-1]  # 与逐个爬取一致，保留最后一个用户的结果
+                self.user_config = last.user_config
+                self.user = last.user
+                self.got_num = last.got_num
+                self.weibo = last.weibo
+                self.weibo_ids = last.weibo_ids
+                return
             for user_config in self.user_config_list:
                 self.initialize_info(user_config)
                 print('*' * 100)
                 self.get_weibo_info()
+                self.crawled[user_config['user_uri']] = (
+                    user_config.get('user_id'), self.user.get('nickname'))
                 print(u'信息抓取完毕')
                 print('*' * 100)
                 if self.user_config_file_path:
                     self.update_user_config_file(self.user_config_file_path)
+        except IdentityExhausted:
+            # 当前用户未写完的数据不保存、不更新断点，下次从原断点处重新爬取
+            self.write_log()
+            sys.exit(u'全部cookie错误或已过期,请按照README中方法重新获取')
         except Exception as e:
-            print('Error: ', e)
-            traceback.print_exc()
+            report_error('start', e)
+        finally:
+            self.fetcher.close()
+
+
+COOKIES_PATH = os.path.split(
+    os.path.realpath(__file__))[0] + os.sep + 'cookies.txt'
+
+def get_cookies(default):
+    """读取cookies.txt中的cookie(每行一个)，文件不存在或为空时使用default"""
+    if not os.path.isfile(COOKIES_PATH):
+        return [default]
+    with open(COOKIES_PATH, encoding='utf-8-sig') as f:
+        cookies = [line.strip() for line in f if line.strip()]
+    return cookies or [default]
 
+def get_config(user_ids, days, offline=0, concurrency=1):
+    """抓取user_ids的爬虫配置，concurrency为同时爬取的用户数"""
+    return {
+        "cache_dir": os.path.split(os.path.realpath(__file__))[0] + os.sep + 'cache',
+        "offline": offline,
+        "concurrency": concurrency,
+        "user_id_list": list(user_ids),
+        "filter": 1,
+        "since_date": days,
+        "write_mode": ["csv", "sqlite"],
+        "pic_download": 0,
+        "video_download": 0,
+        "cookie":get_cookies("_T_WM=70422221270; SCF=AuNWQq_E4fCpWGT9E8bsLNOMjQJNRlPCKdVNNeSfC4FfiEavNL_03aElZYrES3FGpC8y0ELMOUF_-LIk5tAdlek.; SSOLoginState=1582189615; SUB=_2A25zSjx_DeRhGedG41UV8SvFzz6IHXVQtUQ3rDV6PUJbkdANLUX-kW1NUROaXHgNQd0l3AimFXdj3us0g9pVh-sM; SUHB=0sqw45sWuJWbEX")
+    }
 
-def main(weiboid,days):
+def main(weiboid,days,offline=0):
     try:
-        config = {
-    "user_id_list": [weiboid],
-    "filter": 1,
-    "since_date": days,
-    "write_mode": ["csv"],
-    "pic_download": 0,
-    "video_download": 0,
-    "cookie":"_T_WM=70422221270; SCF=AuNWQq_E4fCpWGT9E8bsLNOMjQJNRlPCKdVNNeSfC4FfiEavNL_03aElZYrES3FGpC8y0ELMOUF_-LIk5tAdlek.; SSOLoginState=1582189615; SUB=_2A25zSjx_DeRhGedG41UV8SvFzz6IHXVQtUQ3rDV6PUJbkdANLUX-kW1NUROaXHgNQd0l3AimFXdj3us0g9pVh-sM; SUHB=0sqw45sWuJWbEX"
-}
-        wb = Weibo(config)
+        wb = Weibo(get_config([weiboid], days, offline))
         wb.start()  # 爬取微博信息
         return wb.user['nickname']
     except Exception as e:
-        print('Error: ', e)
-        traceback.print_exc()
-        
-def update_stops(path = 'stopwords.txt'):
-    stop_set = [i.strip() for i in open(path).read().split('\n') if i !='']
-    for i in stop_set:
-        STOPWORDS.add(i)
-    return STOPWORDS
+        report_error('main', e)
+
+def crawl_accounts(user_ids, days, offline=0, concurrency=1):
+    """用同一个爬虫(共享连接池和cookie身份池)抓取多个用户，同时爬取concurrency个，
+    返回{输入的用户id: (用户id, 昵称)}"""
+    try:
+        wb = Weibo(get_config(user_ids, days, offline, concurrency))
+        wb.start()
+        return wb.crawled
+    except Exception as e:
+        report_error('crawl_accounts', e)
+        return {}
         
-def get_texts(path,siglelinenumber,displaylines):
+STOPWORDS_PATH = os.path.split(
+    os.path.realpath(__file__))[0] + os.sep + 'stopwords.txt'
+
+class TokenFilter(object):
+    """分词过滤器：去掉正文中的链接、话题、表情和"原图"、"全文"等链接文字，
+    并在分词时去掉停用词、数字和标点。停用词只在创建时读取一次"""
+    noise = re.compile(
+        r'(?:https?://|www\.|t\.cn/)[\w./?=&%#-]*'  # 链接，如http://t.cn/xxx
+        r'|#[^#\s]{1,30}#'  # 话题
+        r'|\[[^\[\]\s]{1,8}\]'  # 微博表情，如[加油]
+        r'|[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]'  # emoji
+        r'|原图|全文|网页链接|秒拍视频')
+    word = re.compile(r'\w')
+
+    def __init__(self, path=STOPWORDS_PATH):
+        with open(path, encoding='utf-8') as f:
+            words = set(line.strip() for line in f)
+        words.discard('')
+        self.stopwords = frozenset(
+            word.lower() for word in words | set(wordcloud.STOPWORDS))
+        self.digest = hashlib.sha1(
+            ('\n'.join(sorted(self.stopwords)) + self.noise.pattern).encode(
+                'utf-8')).hexdigest()[:16]
+
+    def clean(self, text):
+        """去掉正文中的噪声"""
+        return self.noise.sub(' ', text)
+
+    def keep(self, token):
+        """是否保留分出的词"""
+        token = token.strip()
+        return (token and not token.isdigit() and self.word.search(token)
+                and token.lower() not in self.stopwords)
+
+    def cut(self, text):
+        """分词并过滤"""
+        return [
+            token.strip() for token in jieba.cut(self.clean(text))
+            if self.keep(token)
+        ]
+
+token_filters = {}  # 停用词文件 -> 分词过滤器，每个进程只创建一次
+
+def get_token_filter(path=STOPWORDS_PATH):
+    """获取分词过滤器"""
+    if path not in token_filters:
+        init_jieba()
+        token_filters[path] = TokenFilter(path)
+    return token_filters[path]
+
+def init_jieba():
+    """jieba词典的缓存放在cache目录中(默认在系统临时目录，重启后需要重新生成)，
+    词典在第一次分词时才加载"""
+    if jieba.dt.tmp_dir is None:
+        cache_dir = os.path.split(os.path.realpath(__file__))[0] + os.sep + 'cache'
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        jieba.dt.tmp_dir = cache_dir
+
+def init_segment():
+    """分词进程的初始化：加载jieba词典和分词过滤器"""
+    init_jieba()
+    jieba.initialize()
+    get_token_filter()
+
+def get_data_path(nickname, user_id):
+    """获取用户的数据文件，优先使用SQLite数据库"""
+    path = nickname + os.sep + user_id
+    if os.path.isfile(path + '.db'):
+        return path + '.db'
+    return path + '.csv'
+
+def read_rows(path, since_date=None):
+    """读取微博数据行(列顺序同WeiboRecord.fields)，since_date为yyyy-mm-dd时只读取此后发布的微博"""
+    if path.endswith('.db'):
+        conn = sqlite3.connect(path)
+        try:
+            for row in conn.execute(
+                    'SELECT %s FROM weibo WHERE publish_time >= ? '
+                    'ORDER BY publish_time DESC' % ', '.join(WeiboRecord.fields),
+                    (since_date or '', )):
+                yield row
+        finally:
+            conn.close()
+    else:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            for content in csv.reader(f):
+                if not content or content[0] == '微博id':
+                    continue
+                if since_date and content[3] < since_date:
+                    continue
+                yield content[:8]
+
+def read_posts(path, since_date=None):
+    """读取(微博正文, 发布时间, 点赞数, 微博id)，since_date为yyyy-mm-dd时只读取此后发布的微博"""
+    for row in read_rows(path, since_date):
+        yield row[1].strip(), row[3], str(row[5]), row[0]
+
+path_locks = {}  # 数据文件 -> 更新其分词汇总、互动数索引时使用的锁
+path_locks_lock = threading.Lock()
+
+def get_path_lock(path):
+    """获取数据文件对应的锁，同一进程中多个线程(如图片服务)不会同时更新同一份派生文件"""
+    with path_locks_lock:
+        if path not in path_locks:
+            path_locks[path] = threading.Lock()
+        return path_locks[path]
+
+def load_engagement_index(path, k=10):
+    """读取数据文件对应的互动数索引，索引不存在或比数据文件旧时由数据文件重新生成"""
+    with get_path_lock(path):
+        index = EngagementIndex(os.path.splitext(path)[0] + '.engagement.json', k)
+        if os.path.isfile(path) and (not index.days or os.path.getmtime(
+                index.path) < os.path.getmtime(path)):
+            index.days = {}
+            for row in read_rows(path):
+                index.write(row)
+            index.close()
+            index.count = 0
+        return index
+
+SEGMENT_CHUNK = 200  # 每个分词任务包含的微博数
+segment_pools = {}  # 进程数 -> 分词进程池，多次生成图片时复用
+
+def segment(texts):
+    """对一批微博分词并统计词频"""
+    token_filter = get_token_filter()
+    words = Counter()
+    for text in texts:
+        words.update(token_filter.cut(text))
+    return words
+
+def get_segment_pool(workers):
+    """获取分词进程池，每个进程只加载一次jieba词典"""
+    if workers not in segment_pools:
+        from concurrent.futures import ProcessPoolExecutor  # 会导入multiprocessing，用到时才导入
+        segment_pools[workers] = ProcessPoolExecutor(
+            max_workers=workers, initializer=init_segment)
+    return segment_pools[workers]
+
+class WordCounter(object):
+    """按微博顺序累加词频：每攒够SEGMENT_CHUNK条交给进程池分词，按提交顺序合并，
+    结果(包括词的先后顺序)与单进程分词完全一致。不足一批的微博在本进程分词"""
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.words = Counter()
+        self.chunk = []
+        self.futures = deque()
+
+    def add(self, text):
+        """加入一条微博"""
+        self.chunk.append(text)
+        if len(self.chunk) >= SEGMENT_CHUNK:
+            if self.workers > 1:
+                self.futures.append(
+                    get_segment_pool(self.workers).submit(segment, self.chunk))
+                if len(self.futures) > self.workers * 2:  # 限制排队的任务数
+                    self.words.update(self.futures.popleft().result())
+            else:
+                self.words.update(segment(self.chunk))
+            self.chunk = []
+
+    def result(self):
+        """等待全部分词任务，返回词频"""
+        while self.futures:
+            self.words.update(self.futures.popleft().result())
+        self.words.update(segment(self.chunk))
+        self.chunk = []
+        return self.words
+
+def segment_each(texts):
+    """对一批微博逐条分词，返回每条微博的[(词, 词频)]"""
+    token_filter = get_token_filter()
+    return [list(Counter(token_filter.cut(text)).items()) for text in texts]
+
+class TokenCache(object):
+    """按微博id缓存每条微博的分词词频，正文或停用词变化时失效，只对缓存中没有的微博分词"""
+    def __init__(self, path, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS post_tokens ('
+                          'id TEXT, digest TEXT, counts TEXT, '
+                          'PRIMARY KEY (id, digest))')
+
+    @staticmethod
+    def get_digest(text):
+        """微博正文的摘要，包含分词过滤器的摘要"""
+        return hashlib.sha1(
+            (get_token_filter().digest + text).encode('utf-8')).hexdigest()[:16]
+
+    def get_counts(self, key):
+        """读取缓存的一条微博的词频，没有缓存时返回None"""
+        row = self.conn.execute(
+            'SELECT counts FROM post_tokens WHERE id = ? AND digest = ?',
+            key).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def segment_posts(self, posts):
+        """返回每条微博(id, 正文摘要, 正文)的词频{(id, 正文摘要): [(词, 词频)]}，
+        只对缓存中没有的微博分词(数量较多时使用进程池)并写入缓存"""
+        counts = {}
+        missing = []
+        for weibo_id, digest, text in posts:
+            cached = self.get_counts((weibo_id, digest))
+            if cached is None:
+                missing.append((weibo_id, digest, text))
+            else:
+                counts[weibo_id, digest] = cached
+        texts = [text for _, _, text in missing]
+        chunks = [
+            texts[i:i + SEGMENT_CHUNK]
+            for i in range(0, len(texts), SEGMENT_CHUNK)
+        ]
+        metrics.incr('token_cache_hits', len(counts))
+        metrics.incr('segmented_posts', len(missing))
+        if self.workers > 1 and len(chunks) > 1:
+            results = get_segment_pool(self.workers).map(segment_each, chunks)
+        else:
+            results = map(segment_each, chunks)
+        segmented = [pairs for result in results for pairs in result]
+        with self.conn:
+            for (weibo_id, digest, _), pairs in zip(missing, segmented):
+                counts[weibo_id, digest] = pairs
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO post_tokens VALUES (?, ?, ?)',
+                    (weibo_id, digest, json.dumps(pairs, ensure_ascii=False)))
+        return counts
+
+    def close(self):
+        """关闭数据库"""
+        self.conn.close()
+
+class DailyRollups(object):
+    """按发布日期汇总的词频：全部日期共用一个词表，每天的词频存为词编号和词频两个
+    int32数组。任意起始日期的词频只需合并这些天的数组(numpy.bincount)，
+    切换时间范围不用重新抓取和分词。与TokenCache保存在同一个数据库中"""
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS vocab ('
+                          'tid INTEGER PRIMARY KEY, token TEXT UNIQUE)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS daily ('
+                          'day TEXT PRIMARY KEY, version TEXT, '
+                          'tids BLOB, counts BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                          'name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+        self.load()
+
+    def load(self):
+        """读取词表和每天的词频"""
+        self.tokens = []  # 词编号 -> 词
+        for tid, token in self.conn.execute('SELECT tid, token FROM vocab'):
+            if tid >= len(self.tokens):
+                self.tokens.extend([None] * (tid + 1 - len(self.tokens)))
+            self.tokens[tid] = token
+        self.vocab = {
+            token: tid
+            for tid, token in enumerate(self.tokens) if token is not None
+        }
+        self.days = {}  # 日期 -> (版本, 词编号数组, 词频数组)
+        for day, version, tids, counts in self.conn.execute(
+                'SELECT day, version, tids, counts FROM daily'):
+            self.days[day] = (version, np.frombuffer(tids, dtype=np.int32),
+                              np.frombuffer(counts, dtype=np.int32))
+
+    def get_source(self, data_path):
+        """汇总对应的数据文件版本(路径、大小、修改时间)和分词过滤器"""
+        return get_data_version(data_path) + ':' + get_token_filter().digest
+
+    def update(self, data_path):
+        """按数据文件更新：数据文件和分词过滤器没有变化时直接返回；否则只重算微博有变化的
+        日期，只对缓存中没有的微博分词。词表在写事务中追加，多个进程可同时更新"""
+        source = self.get_source(data_path)
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE name = 'source'").fetchone()
+        if row and row[0] == source:
+            return
+        posts = {}  # 日期 -> [(id, 正文摘要, 正文)]
+        for row in read_rows(data_path):
+            text = row[1].strip()
+            posts.setdefault(row[3][:10], []).append(
+                (row[0], TokenCache.get_digest(text), text))
+        versions = {
+            day: hashlib.sha1('\n'.join(sorted(
+                '%s:%s' % (weibo_id, digest)
+                for weibo_id, digest, _ in day_posts)).encode(
+                    'utf-8')).hexdigest()[:16]
+            for day, day_posts in posts.items()
+        }
+        changed = [
+            day for day in posts
+            if day not in self.days or self.days[day][0] != versions[day]
+        ]
+        removed = [day for day in self.days if day not in posts]
+        token_cache = TokenCache(self.path, self.workers)
+        counts = token_cache.segment_posts(
+            [post for day in changed for post in posts[day]])
+        token_cache.close()
+        day_words = {}
+        for day in changed:
+            words = Counter()
+            for weibo_id, digest, _ in posts[day]:
+                words.update(dict(counts[weibo_id, digest]))
+            day_words[day] = words
+        with self.conn:
+            # 写锁期间追加新词并重新读取词表，其他进程同时加入的词使用同一个编号
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO vocab (token) VALUES (?)',
+                [(token, ) for words in day_words.values() for token in words
+                 if token not in self.vocab])
+            self.load()
+            rows = []
+            for day, words in day_words.items():
+                tids = np.array([self.vocab[token] for token in words],
+                                dtype=np.int32)
+                day_counts = np.array(list(words.values()), dtype=np.int32)
+                self.days[day] = (versions[day], tids, day_counts)
+                rows.append((day, versions[day], tids.tobytes(),
+                             day_counts.tobytes()))
+            for day in removed:
+                self.days.pop(day, None)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?)', rows)
+            self.conn.executemany('DELETE FROM daily WHERE day = ?',
+                                  [(day, ) for day in removed])
+            # 删除正文已变化的微博的旧词频
+            self.conn.executemany(
+                'DELETE FROM post_tokens WHERE id = ? AND digest != ?',
+                [(weibo_id, digest) for day in changed
+                 for weibo_id, digest, _ in posts[day]])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)",
+                              (source, ))
+
+    def window(self, since_date=None, until_date=None):
+        """返回发布日期在[since_date, until_date]内的词频，按词频和词排序"""
+        days = [
+            day for day in self.days
+            if (not since_date or day >= since_date[:10]) and (
+                not until_date or day <= until_date[:10])
+        ]
+        if not days:
+            return Counter()
+        totals = np.bincount(
+            np.concatenate([self.days[day][1] for day in days]),
+            weights=np.concatenate([self.days[day][2] for day in days]),
+            minlength=len(self.tokens))
+        words = [(self.tokens[tid], int(totals[tid]))
+                 for tid in np.flatnonzero(totals)]
+        return Counter(
+            dict(sorted(words, key=lambda item: (-item[1], item[0]))))
+
+    def close(self):
+        """关闭数据库"""
+        self.conn.close()
+
+def get_window_words(path, since_date=None, workers=None):
+    """由按天汇总的词频返回since_date以来的词频，数据文件有更新时先更新汇总"""
+    with get_path_lock(path):
+        rollups = DailyRollups(os.path.splitext(path)[0] + '.tokens.db', workers)
+        try:
+            rollups.update(path)
+            return rollups.window(since_date)
+        finally:
+            rollups.close()
+
+def get_texts(path,siglelinenumber,displaylines,since_date=None,top_k=3,workers=None,token_cache=True):
+    """返回(词频, 点赞最多的微博的展示文本)，点赞数最多的top_k条微博从互动数索引中查询。
+    token_cache为True时词频由按天汇总的词频合并得到(只对新增的微博分词)；为False时
+    流式读取数据逐条分词累加，workers为分词进程数，默认为CPU核数"""
     cur_time = time.strftime("%Y-%m-%d %H:%M", time.localtime())
-    all_contents1,all_contents2 = csv.reader(open(path,'r')),csv.reader(open(path,'r'))
-    display_contents = [(content[1].strip(),content[3],content[7]) for content in all_contents1 if content[7]!='点赞数']
-    cloud_contents = " ".join(jieba.cut(''.join([content[1].strip() for content in all_contents2])))
+    with metrics.timer('segment'):
+        if token_cache:
+            cloud_contents = get_window_words(path, since_date, workers)
+        else:
+            word_counter = WordCounter(workers)
+            for post in read_posts(path, since_date):
+                word_counter.add(post[0])
+            cloud_contents = word_counter.result()
     
-    display_content = sorted(display_contents,key =lambda x:int(x[2]),reverse =True)[0:3]
+    with metrics.timer('top_posts'):
+        display_content = [
+            (post[0], post[1], str(post[2])) for post in load_engagement_index(
+                path).top(top_k, 'up_num', since_date)
+        ]
     display_content_new = ''
     n = siglelinenumber
     for i in display_content:
@@ -732,61 +2117,526 @@ def get_texts(path,siglelinenumber,displaylines):
     
     return cloud_contents,'-'*24 + u'近日原创点赞热门' + '-'*24 + '\n'*3 + display_content_new + '-'*15 + cur_time + ' By Hylan129' + '-'*15
 
-def cloud_pic(cloud_contents,max_words=150,backgroud_pic_path=r'run.png'):
-    wc = WordCloud(stopwords= update_stops(), max_words= max_words, collocations=False, 
+def filter_words(words, stopwords):
+    """按WordCloud.generate的规则处理分词结果的词频：拆出单词，去掉数字和停用词，
+    合并大小写及英文复数"""
+    stopwords = set(word.lower() for word in stopwords)
+    cases = {}  # 小写形式 -> {原始形式: 词频}
+    for token, count in words.items():
+        for word in re.findall(r"\w[\w']*", token):
+            if word.lower().endswith("'s"):
+                word = word[:-2]
+            if word.isdigit() or word.lower() in stopwords:
+                continue
+            case_dict = cases.setdefault(word.lower(), {})
+            case_dict[word] = case_dict.get(word, 0) + count
+    for key in list(cases):
+        if key.endswith('s') and not key.endswith('ss') and key[:-1] in cases:
+            for word, count in cases.pop(key).items():
+                singular = cases[key[:-1]]
+                singular[word[:-1]] = singular.get(word[:-1], 0) + count
+    frequencies = {}
+    for case_dict in cases.values():
+        word = max(case_dict.items(), key=lambda item: item[1])[0]
+        frequencies[word] = sum(case_dict.values())
+    return frequencies
+
+FONT_CANDIDATES = [
+    '/System/Library/Fonts/STHeiti Light.ttc',  # macOS
+    '/System/Library/Fonts/PingFang.ttc',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',  # Linux
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',
+    '/usr/share/fonts/wqy-microhei/wqy-microhei.ttc',
+    'C:\\Windows\\Fonts\\msyh.ttc',  # Windows
+    'C:\\Windows\\Fonts\\simhei.ttf',
+]
+
+@lru_cache(maxsize=None)
+def get_font_path():
+    """查找中文字体：优先使用环境变量WEIBO_FONT，其次是各系统自带的中文字体，
+    都没有时使用wordcloud自带的字体(不能显示中文)"""
+    font_path = os.environ.get('WEIBO_FONT')
+    if font_path:
+        if os.path.isfile(font_path):
+            return font_path
+        print(u'字体文件%s不存在' % font_path)
+    for font_path in FONT_CANDIDATES:
+        if os.path.isfile(font_path):
+            return font_path
+    print(u'没有找到中文字体，请通过环境变量WEIBO_FONT指定字体文件')
+    return wordcloud.wordcloud.FONT_PATH
+
+@lru_cache(maxsize=32)
+def get_font(font_path, size):
+    """加载字体，同一进程中相同(字体, 字号)只加载一次"""
+    return ImageFont.truetype(font_path, size)
+
+@lru_cache(maxsize=8)
+def get_mask(path):
+    """读取词云形状图片为numpy数组，同一进程中只读取一次(数组只读)"""
+    mask = imageio.imread(path, pilmode="RGB")
+    mask.setflags(write=False)
+    return mask
+
+@lru_cache(maxsize=8)
+def get_grid_mask(path, grid):
+    """将词云形状缩小为grid倍的网格：块内有被遮挡(白色)的像素时整块遮挡，
+    保证放大后词不会画到形状外"""
+    mask = get_mask(path)
+    masked = np.all(mask[:, :, :3] == 255, axis=-1)
+    height, width = masked.shape
+    masked = np.pad(masked, ((0, -height % grid), (0, -width % grid)),
+                    mode='constant', constant_values=True)
+    blocks = masked.reshape(masked.shape[0] // grid, grid,
+                            masked.shape[1] // grid, grid).any(axis=(1, 3))
+    grid_mask = np.where(blocks, 255, 0).astype(np.uint8)
+    grid_mask.setflags(write=False)
+    return grid_mask
+
+class EmptyCloud(ValueError):
+    """时间范围内没有可生成词云的微博"""
+
+
+def cloud_pic(cloud_contents,max_words=150,backgroud_pic_path=r'run.png',layout='full',grid=4,width=880):
+    """cloud_contents为分词后的词频(也可以是空格分隔的文本)，返回词云图片(PIL.Image)。
+    layout为'full'时在形状图片的原始分辨率上排布；为'grid'时在缩小grid倍的网格上排布，
+    只在最后按目标宽度width绘制，形状图片较大时快很多"""
+    stopwords = get_token_filter().stopwords
+    if layout == 'grid':
+        mask = get_grid_mask(backgroud_pic_path, grid)
+        scale = float(width) / mask.shape[1]
+    elif layout == 'full':
+        mask = get_mask(backgroud_pic_path)
+        scale = 1
+    else:
+        raise ValueError(u'layout必须为full或grid')
+    wc = wordcloud.WordCloud(stopwords= stopwords, max_words= max_words, collocations=False, 
                background_color="RGB(20,255,155)", 
-               font_path='/System/Library/Fonts/STHeiti Light.ttc', random_state=42, 
-               mask=imread(backgroud_pic_path,pilmode="RGB"))
-    wc.generate(cloud_contents)
-    wc.to_file("ciyun_run.png")
+               font_path=get_font_path(), random_state=42, 
+               mask=mask, scale=scale)
+    with metrics.timer('cloud_layout'):
+        if isinstance(cloud_contents, str):
+            wc.generate(cloud_contents)
+        else:  # 停用词已在分词时去掉，这里只按WordCloud的规则合并大小写及复数
+            words = filter_words(cloud_contents, stopwords)
+            if not words:
+                raise EmptyCloud(u'时间范围内没有微博，无法生成词云')
+            wc.generate_from_frequencies(words)
+    with metrics.timer('cloud_draw'):
+        return wc.to_image()
 
 #生成空白照片
-def pic_blank(name):
-    img = Image.new('RGB', (1080, 1920), (20, 255, 155))
-    img.save(name +'.png')
-    return name + '.png'
+def pic_blank(size=(1080, 1920)):
+    """返回空白的底图(PIL.Image)"""
+    return Image.new('RGB', size, (20, 255, 155))
 
-def pic_display(pic_file,position,headers,font_size):
-
-    image = Image.open(pic_file)
+def pic_display(image,position,headers,font_size):
+    """在图片上写入文字，image为PIL.Image或图片文件，返回写入后的图片"""
+    if not isinstance(image, Image.Image):
+        image = Image.open(image).convert('RGB')
     draw = ImageDraw.Draw(image)
-    width, height = image.size
     
     # 设置字体样式
-    font_type = '/System/Library/Fonts/STHeiti Light.ttc'
-    font = ImageFont.truetype(font_type, font_size)
+    font = get_font(get_font_path(), font_size)
     color = "#000000"
     if type(headers) != list:
         draw.text(position, headers, color, font)
-        image.save('pic_base.png')
     else:
         draw.multiline_text(position, '\n'.join(headers), color, font)
-        image.save('pic_base.png')
+    return image
 #图片合并
 
-def pic_mix(nickname='',bottom_pic='pic_base.png',top_pic='ciyun_run.png',box=(100,100,980,600)):
-    #加载底图
-    base_img = Image.open(bottom_pic)
-
-    #加载需要P上去的图片
-    region = Image.open(top_pic)
+def pic_mix(base_img,region,box=(100,100,980,600)):
+    """将region缩放后贴到底图的box区域，参数为PIL.Image或图片文件，返回合并后的底图"""
+    if not isinstance(base_img, Image.Image):
+        base_img = Image.open(base_img).convert('RGB')
+    if not isinstance(region, Image.Image):
+        region = Image.open(region)
     region = region.resize((box[2] - box[0], box[3] - box[1]))
     base_img.paste(region, box)
-    base_img.save("./"+ nickname + '/yourneed.png') #保存图片
+    return base_img
 
-if __name__ == '__main__':
-    
+def render_picture(nickname,cloud_contents,display_content,layout='full'):
+    """在内存中合成最终图片：底图、点赞最多的微博、标题和词云，返回PIL.Image"""
+    cloud = cloud_pic(cloud_contents,layout=layout)
+    with metrics.timer('compose'):
+        image = pic_blank()
+        pic_display(image,(100,800),display_content,36)
+        pic_display(image,(310,650),nickname + '微博词云',65)
+        return pic_mix(image,cloud)
+
+def encode_png(image):
+    """将图片编码为PNG数据"""
+    with metrics.timer('encode_png'):
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        return buf.getvalue()
+
+def save_picture(image,path):
+    """编码一次并写入文件(先写临时文件再替换，同时生成的图片不会互相覆盖)"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    content = encode_png(image)
+    with metrics.timer('save'):
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+def get_since_date(days):
+    """将天数转换为yyyy-mm-dd，已经是日期时直接返回"""
+    days = str(days)
+    if days.isdigit():
+        return str(date.today() - timedelta(int(days)))
+    return days
+
+def init_render():
+    """预先加载jieba词典、分词过滤器、字体和词云形状图片，批量生成时每个进程只加载一次"""
+    init_segment()
+    get_mask('run.png')
+    for size in (36, 65):
+        get_font(get_font_path(), size)
+
+def render_account(path, nickname, since_date, layout='full'):
+    """由数据文件生成一个账号的图片，返回(图片路径, 各阶段耗时)"""
+    timings = OrderedDict()
+    start = time.perf_counter()
+    cloud_content, display_content = get_texts(path, 24, 5, since_date, workers=1)
+    timings['texts'] = time.perf_counter() - start
+    start = time.perf_counter()
+    picture = render_picture(nickname, cloud_content, display_content, layout)
+    timings['render'] = time.perf_counter() - start
+    start = time.perf_counter()
+    picture_path = save_picture(
+        picture, os.path.dirname(path) + os.sep + 'yourneed.png')
+    timings['save'] = time.perf_counter() - start
+    return picture_path, timings
+
+def render_account_task(path, nickname, since_date, layout='full'):
+    """在批量生成的子进程中生成一个账号的图片，同时返回这次的运行指标供主进程合并"""
+    metrics.reset()
+    result = render_account(path, nickname, since_date, layout)
+    return result, metrics.snapshot()
+
+def find_data_path(user_id):
+    """在已抓取的数据中查找用户的数据文件"""
+    for base_dir in [os.getcwd(), os.path.split(os.path.realpath(__file__))[0]]:
+        for ext in ['.db', '.csv']:
+            for path in sorted(os.listdir(base_dir)):
+                if os.path.isfile(os.path.join(base_dir, path, user_id + ext)):
+                    return os.path.join(base_dir, path, user_id + ext)
+
+def get_batch_targets(targets, days, crawl=True, offline=0, concurrency=1):
+    """将用户id或数据文件(<nickname>/<id>.csv或.db)转换为[(数据文件, 昵称)]，
+    用户id默认先用同一个爬虫全部抓取(同时爬取concurrency个)，crawl为False时使用已有的数据"""
+    crawled = {}
+    if crawl:
+        user_ids = [target for target in targets if not os.path.isfile(target)]
+        if user_ids:
+            crawled = crawl_accounts(user_ids, days, offline, concurrency)
+    accounts = []
+    for target in targets:
+        if os.path.isfile(target):
+            path = target
+            nickname = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        elif crawl:
+            user_id, nickname = crawled.get(target, (None, None))
+            path = get_data_path(nickname, user_id) if nickname else None
+        else:
+            path = find_data_path(target)
+            nickname = os.path.basename(os.path.dirname(path)) if path else None
+        if path and os.path.isfile(path):
+            accounts.append((path, nickname))
+        else:
+            print(u'没有找到%s的数据，跳过' % target)
+    return accounts
+
+def batch_render(targets, days, workers=None, crawl=True, offline=0, layout='full',
+                 concurrency=1):
+    """在一个进程(池)中批量生成多个账号的图片，打印每个账号的耗时"""
+    accounts = get_batch_targets(targets, days, crawl, offline, concurrency)
+    since_date = get_since_date(days)
+    workers = min(workers or os.cpu_count() or 1, max(len(accounts), 1))
+    start = time.perf_counter()
+    init_render()  # fork出的子进程直接继承已加载的状态
+    warm_time = time.perf_counter() - start
+    print(u'共%d个账号，%d个进程，预加载耗时%.2f秒' % (len(accounts), workers, warm_time))
+    pool = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_render)
+        futures = [
+            pool.submit(render_account_task, path, nickname, since_date, layout)
+            for path, nickname in accounts
+        ]
+    results = []
+    for i, (path, nickname) in enumerate(accounts):
+        try:
+            if pool:
+                (picture_path, timings), snapshot = futures[i].result()
+                metrics.merge(snapshot)
+            else:
+                picture_path, timings = render_account(path, nickname,
+                                                       since_date, layout)
+            results.append((nickname, picture_path, timings))
+            print(u'%s: %s 分词%.2f秒 绘图%.2f秒 保存%.2f秒' %
+                  (nickname, picture_path, timings['texts'], timings['render'],
+                   timings['save']))
+        except EmptyCloud as e:
+            print(u'%s: %s，跳过' % (nickname, e))
+        except Exception as e:
+            report_error('batch_render', e)
+    if pool:
+        pool.shutdown()
+    print(u'完成%d/%d个账号，共耗时%.2f秒' %
+          (len(results), len(accounts), time.perf_counter() - start))
+    return results
+
+def get_data_version(path):
+    """数据文件的版本：由路径、大小和修改时间计算的摘要，数据更新后随之改变"""
+    stat = os.stat(path)
+    return hashlib.sha1(('%s:%d:%d' % (os.path.abspath(path), stat.st_size,
+                                       stat.st_mtime_ns)).encode('utf-8')).hexdigest()[:16]
+
+class RenderService(object):
+    """常驻的图片生成服务：jieba、字体和形状图片只加载一次，生成的PNG按
+    (用户id, 起始日期, 排布方式, 数据版本)缓存(LRU)；同一图片正在生成时，
+    其他请求等待这次的结果而不重复生成"""
+    def __init__(self, cache_size=64, render_workers=2):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # key -> PNG数据
+        self.inflight = {}  # key -> 正在生成的Future
+        self.lock = threading.Lock()
+        self.render_slots = threading.BoundedSemaphore(render_workers)  # 同时生成的图片数
+
+    def get_key(self, user_id, days, layout):
+        """返回(数据文件, 缓存key)，找不到用户的数据时数据文件为None"""
+        path = find_data_path(user_id)
+        if not path:
+            return None, None
+        return path, (user_id, get_since_date(days), layout,
+                      get_data_version(path))
+
+    def get_picture(self, user_id, days, layout='full'):
+        """返回(PNG数据, 缓存key)，找不到用户的数据时返回(None, None)"""
+        path, key = self.get_key(user_id, days, layout)
+        if not path:
+            return None, None
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                metrics.incr('render_cache', label='hit')
+                return self.cache[key], key
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            metrics.incr('render_cache', label='shared')
+            return future.result(), key
+        metrics.incr('render_cache', label='miss')
+        try:
+            with self.render_slots, metrics.timer('render_request'):
+                nickname = os.path.basename(os.path.dirname(os.path.abspath(path)))
+                cloud_content, display_content = get_texts(
+                    path, 24, 5, key[1], workers=1)
+                content = encode_png(
+                    render_picture(nickname, cloud_content, display_content,
+                                   layout))
+        except Exception as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.cache[key] = content
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            del self.inflight[key]
+        future.set_result(content)
+        return content, key
+
+class RenderHandler(object):
+    """图片服务的请求处理(与BaseHTTPRequestHandler组合使用，见serve)：
+    GET /picture/<用户id>.png?days=30&layout=full  生成的图片
+    GET /metrics  Prometheus格式的运行指标"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            return self.send(200, metrics.to_prometheus().encode('utf-8'),
+                             'text/plain; version=0.0.4')
+        match = re.match(r'^/picture/(\w+)\.png$', url.path)
+        if not match:
+            return self.send(404, b'Not Found', 'text/plain')
+        query = parse_qs(url.query)
+        days = query.get('days', ['30'])[0]
+        layout = query.get('layout', ['full'])[0]
+        if layout not in ('full', 'grid') or not re.match(
+                r'^(\d+|\d{4}-\d{2}-\d{2})$', days):
+            return self.send(400, b'Bad Request', 'text/plain')
+        try:
+            content, key = self.server.service.get_picture(
+                match.group(1), days, layout)
+        except EmptyCloud as e:
+            metrics.incr('render_empty')
+            return self.send(404, str(e).encode('utf-8'),
+                             'text/plain; charset=utf-8')
+        except Exception as e:
+            report_error('serve', e)
+            return self.send(500, b'Internal Server Error', 'text/plain')
+        if content is None:
+            return self.send(404, b'Not Found', 'text/plain')
+        etag = '"%s"' % hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, b'', None, etag)
+        self.send(200, content, 'image/png', etag)
+
+    def send(self, status, content, content_type, etag=None):
+        """发送响应"""
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        metrics.incr('http_requests')
+
+def serve(host='127.0.0.1', port=8080, cache_size=64, render_workers=2):
+    """启动图片服务"""
+    start = time.perf_counter()
+    init_render()
+    # http.server只在启动服务时导入，抓取和生成图片时不需要
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    handler = type('RenderRequestHandler',
+                   (RenderHandler, BaseHTTPRequestHandler), {})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = RenderService(cache_size, render_workers)
+    print(u'预加载耗时%.2f秒，图片服务已启动：http://%s:%d/picture/<用户id>.png?days=30' %
+          (time.perf_counter() - start, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def crawl_main(args):
+    """只抓取微博，不导入分词和绘图相关的库"""
+    nickname = main(args.user_id, args.days, int(args.offline))
+    print("nickname已获取！",nickname)
+    return nickname
+
+def render_main(args):
+    """由已抓取的数据生成图片，不导入抓取相关的库"""
+    if os.path.isfile(args.target):
+        path = args.target
+    else:
+        path = find_data_path(args.target)
+    if not path:
+        sys.exit(u'没有找到%s的数据，请先抓取' % args.target)
+    nickname = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    try:
+        picture_path, _ = render_account(path, nickname,
+                                         get_since_date(args.days), args.layout)
+    except EmptyCloud as e:
+        sys.exit(u'%s：%s' % (nickname, e))
+    print("请查看生成的图片：%s" % picture_path)
+
+def serve_main(args):
+    """启动图片服务"""
+    serve(args.host, args.port, args.cache_size, args.render_workers)
+
+def batch_main(args):
+    """批量生成多个账号的图片"""
+    batch_render(args.targets, args.days, args.workers, args.crawl,
+                 int(args.offline), args.layout, args.concurrency)
+
+def legacy_main(argv):
+    """原来的调用方法：python weibo_cloud.py 用户id 天数 [--offline]，抓取后生成图片"""
     #输入信息：
     #id = '2113342561' #'1750070171' #用户ID
     #days = 300 #抓取天数
     #抓取数据：
-    nickname = main(str(sys.argv[1]),sys.argv[2])
+    nickname = main(str(argv[0]),argv[1],int('--offline' in argv[2:]))
     print("nickname已获取！",nickname)
-    path = nickname + os.sep + str(sys.argv[1]) + '.csv'
+    path = get_data_path(nickname, str(argv[0]))
+    since_date = get_since_date(argv[1])
     
-    cloud_content,display_content= get_texts(path,24,5)
-    pic_display(pic_blank('mobile'),(100,800),display_content,36)
-    pic_display('pic_base.png',(310,650),nickname + '微博词云',65)
-    cloud_pic(cloud_content)
-    pic_mix(nickname)
-    print("请查看生成的图片：need.png")
\ No newline at end of file
+    cloud_content,display_content= get_texts(path,24,5,since_date)
+    try:
+        picture = render_picture(nickname,cloud_content,display_content)
+    except EmptyCloud as e:
+        sys.exit(u'%s：%s' % (nickname, e))
+    print("请查看生成的图片：%s" % save_picture(
+        picture, nickname + os.sep + 'yourneed.png'))
+
+COMMANDS = ['crawl', 'render', 'batch', 'serve']
+
+def get_parser():
+    """命令行参数"""
+    parser = argparse.ArgumentParser(
+        prog='weibo_cloud.py',
+        description=u'抓取微博并生成词云图片。也可以直接使用：'
+        u'python weibo_cloud.py 用户id 天数 [--offline]')
+    parser.add_argument('--metrics', default=os.environ.get('WEIBO_METRICS'),
+                        help=u'运行结束后将各阶段耗时和计数写入此json文件，'
+                        u'默认为环境变量WEIBO_METRICS')
+    parser.add_argument('--prometheus', default=os.environ.get('WEIBO_PROMETHEUS'),
+                        help=u'同时写入Prometheus文本格式的文件，默认为环境变量WEIBO_PROMETHEUS')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    crawl_parser = subparsers.add_parser('crawl', help=u'只抓取微博')
+    crawl_parser.add_argument('user_id', help=u'用户id')
+    crawl_parser.add_argument('days', help=u'抓取的天数或起始日期')
+    crawl_parser.add_argument('--offline', action='store_true', help=u'只使用本地缓存')
+    crawl_parser.set_defaults(func=crawl_main)
+    render_parser = subparsers.add_parser('render', help=u'由已抓取的数据生成图片')
+    render_parser.add_argument('target', help=u'用户id或<nickname>/<id>.csv')
+    render_parser.add_argument('days', help=u'分析的天数或起始日期')
+    render_parser.add_argument('--layout', choices=['full', 'grid'], default='full',
+                               help=u'词云排布方式，grid在缩小的网格上排布，更快')
+    render_parser.set_defaults(func=render_main)
+    batch_parser = subparsers.add_parser('batch', help=u'批量生成多个账号的图片')
+    batch_parser.add_argument('targets', nargs='+', help=u'用户id或<nickname>/<id>.csv')
+    batch_parser.add_argument('--days', default='30', help=u'分析的天数或起始日期')
+    batch_parser.add_argument('--workers', type=int, default=None, help=u'进程数')
+    batch_parser.add_argument('--no-crawl', dest='crawl', action='store_false',
+                              help=u'用户id使用已抓取的数据，不重新抓取')
+    batch_parser.add_argument('--offline', action='store_true', help=u'只使用本地缓存抓取')
+    batch_parser.add_argument('--concurrency', type=int, default=1,
+                              help=u'同时抓取的用户数')
+    batch_parser.add_argument('--layout', choices=['full', 'grid'], default='full',
+                              help=u'词云排布方式，grid在缩小的网格上排布，更快')
+    batch_parser.set_defaults(func=batch_main)
+    serve_parser = subparsers.add_parser('serve', help=u'启动图片服务')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--cache-size', type=int, default=64,
+                              help=u'缓存的图片数')
+    serve_parser.add_argument('--render-workers', type=int, default=2,
+                              help=u'同时生成的图片数')
+    serve_parser.set_defaults(func=serve_main)
+    return parser
+
+if __name__ == '__main__':
+    parser = get_parser()
+    if (len(sys.argv) > 2 and sys.argv[1] not in COMMANDS and
+            not sys.argv[1].startswith('-')):
+        try:
+            legacy_main(sys.argv[1:])
+        finally:
+            metrics.write(os.environ.get('WEIBO_METRICS'),
+                          os.environ.get('WEIBO_PROMETHEUS'))
+    else:
+        args = parser.parse_args()
+        try:
+            args.func(args)
+        finally:
+            metrics.write(args.metrics, args.prometheus)